@@ -0,0 +1,308 @@
+"""Нагрузочный тест пересылки без настоящих Max и Telegram.
+
+В отдельном процессе поднимаются заглушки: вебсокет Max (opcode 1/6/19/32/49/64/83/88/128), CDN с файлами
+и Bot API. В этом процессе работает обычный main.main(), который подключается к заглушкам. В конце печатается
+пропускная способность, задержка p50/p99 (от отправки кадра в Max до последнего запроса в Bot API по этому
+сообщению), пиковая память процесса пересылки и сколько раз Bot API ответил 429.
+
+    python bench.py --messages 2000 --rate 200 --chats 20 --mix text=70,photo=10,file=10,video=5,album=5
+
+С --max-p99-ms / --min-throughput код выхода 1, если результат хуже, - так удобно ловить регрессии в CI.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+
+KINDS = ("text", "dm", "photo", "file", "video", "album")
+_MESSAGE_TAG = re.compile(r"msg-(\d+)")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест пересылки Max -> Telegram на заглушках")
+    parser.add_argument("--messages", type=int, default=1000, help="сколько сообщений всего")
+    parser.add_argument("--rate", type=float, default=0, help="сообщений в секунду на все аккаунты (0 - без пауз)")
+    parser.add_argument("--accounts", type=int, default=1, help="сколько аккаунтов Max")
+    parser.add_argument("--chats", type=int, default=10, help="сколько групп у каждого аккаунта")
+    parser.add_argument("--mix", default="text=80,photo=8,file=6,video=3,album=3",
+                        help=f"доли типов сообщений, типы: {', '.join(KINDS)}")
+    parser.add_argument("--noise", type=int, default=1, help="служебных кадров (присутствие и т.п.) на сообщение")
+    parser.add_argument("--attach-size", type=int, default=256 * 1024, help="размер файла на CDN, байт")
+    parser.add_argument("--local-api", action="store_true",
+                        help="считать заглушку своим Bot API сервером (файлы до 2ГБ); по умолчанию лимиты обычного API")
+    parser.add_argument("--tg-latency-ms", type=float, default=5, help="задержка ответа Bot API")
+    parser.add_argument("--p429", type=float, default=0, help="доля запросов, на которые Bot API отвечает 429")
+    parser.add_argument("--timeout", type=float, default=300, help="сколько секунд ждать доставки всего")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="вывести результат одной json-строкой")
+    parser.add_argument("--max-p99-ms", type=float, default=0, help="упасть, если p99 больше")
+    parser.add_argument("--min-throughput", type=float, default=0, help="упасть, если сообщений в секунду меньше")
+    args = parser.parse_args(argv)
+    mix = {}
+    for item in args.mix.split(","):
+        kind, _, weight = item.partition("=")
+        if kind.strip() not in KINDS:
+            parser.error(f"неизвестный тип в --mix: {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    args.mix = mix
+    args.accounts = max(args.accounts, 1)
+    args.chats = max(args.chats, 1)
+    # поровну на каждый аккаунт
+    args.messages = max(args.messages // args.accounts, 1) * args.accounts
+    return args
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def build_message(n, kind, chat_id, sender, base_url):
+    """Кадр Max и сколько запросов в Bot API по нему ждать (альбомную подпись "Фото/Видео" не считаем)."""
+    text = f"сообщение msg-{n}"
+    attaches = []
+    if kind == "photo":
+        attaches = [{"_type": "PHOTO", "photoId": n, "baseUrl": f"{base_url}/cdn/{n}", "name": f"msg-{n}.jpg"}]
+    elif kind == "file":
+        attaches = [{"_type": "FILE", "fileId": n, "name": f"msg-{n}.bin"}]
+    elif kind == "video":
+        attaches = [{"_type": "VIDEO", "videoId": n, "name": f"msg-{n}.mp4"}]
+    elif kind == "album":
+        attaches = [
+            {"_type": "PHOTO", "photoId": f"{n}a", "baseUrl": f"{base_url}/cdn/{n}a", "name": f"msg-{n}-a.jpg"},
+            {"_type": "PHOTO", "photoId": f"{n}b", "baseUrl": f"{base_url}/cdn/{n}b", "name": f"msg-{n}-b.jpg"},
+        ]
+    message = {"id": n, "sender": sender, "text": text, "time": int(time.time() * 1000), "attaches": attaches}
+    if kind == "dm":
+        frame = {"ver": 11, "cmd": 0, "seq": 0, "opcode": 64, "payload": {"chatId": sender, "message": message}}
+    else:
+        frame = {"ver": 11, "cmd": 0, "seq": 0, "opcode": 128, "payload": {"chatId": chat_id, "message": message}}
+    return frame, 1 + (1 if attaches else 0)
+
+
+async def serve_fakes(args, ready, results):
+    import websockets
+    from aiohttp import web
+
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*args.mix.items())
+    per_account = args.messages // args.accounts
+    blob = os.urandom(args.attach_size)
+    sent_at = {}  # {n: когда кадр ушёл в вебсокет}
+    expected = {}  # {n: сколько запросов Bot API ждём}
+    arrived = {}  # {n: [сколько пришло, когда последний]}
+    delivered = 0
+    stats = {"requests": 0, "429": 0, "bytes_uploaded": 0, "cdn_requests": 0, "rpc": 0}
+    done = asyncio.Event()
+    base_url = None
+    pushed = set()  # аккаунты, которым уже отдали поток; после переподключения его не повторяем
+
+    async def push(ws, account_index):
+        interval = args.accounts / args.rate if args.rate > 0 else 0
+        started = time.monotonic()
+        for i in range(per_account):
+            n = account_index * per_account + i + 1
+            chat_id = 1000 + rng.randrange(args.chats)
+            frame, parts = build_message(n, rng.choices(kinds, weights)[0], chat_id, 10 + rng.randrange(50), base_url)
+            expected[n] = parts
+            for _ in range(args.noise):
+                await ws.send(json.dumps({"ver": 11, "cmd": 0, "seq": 0, "opcode": 292,
+                                          "payload": {"userId": 10, "presence": {"seen": int(time.time())}}}))
+            sent_at[n] = time.time()
+            await ws.send(json.dumps(frame, ensure_ascii=False))
+            if interval:
+                delay = started + (i + 1) * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+    async def max_server(ws):
+        async for raw in ws:
+            frame = json.loads(raw)
+            opcode, seq, payload = frame.get("opcode"), frame.get("seq"), frame.get("payload") or {}
+            reply = {"ver": 11, "cmd": 1, "seq": seq, "opcode": opcode, "payload": {}}
+            if opcode == 19:
+                account_index = int(payload["token"].rsplit("-", 1)[1])
+                reply["payload"] = {
+                    "chats": [{"id": 1000 + i, "type": "CHAT", "title": f"Группа {i}"} for i in range(args.chats)],
+                    "profile": {"contact": {"id": 1, "names": [{"name": "Бот"}]}},
+                }
+                await ws.send(json.dumps(reply, ensure_ascii=False))
+                if account_index not in pushed:
+                    pushed.add(account_index)
+                    asyncio.create_task(push(ws, account_index))
+                continue
+            stats["rpc"] += 1
+            if opcode == 32:
+                reply["payload"] = {"contacts": [{"id": c, "names": [{"name": f"Пользователь {c}"}]}
+                                                 for c in payload.get("contactIds", [])]}
+            elif opcode == 83:
+                reply["payload"] = {"MP4_720": f"{base_url}/cdn/v{payload.get('videoId')}"}
+            elif opcode == 88:
+                reply["payload"] = {"url": f"{base_url}/cdn/f{payload.get('fileId')}"}
+            elif opcode == 49:
+                reply["payload"] = {"messages": []}
+            await ws.send(json.dumps(reply, ensure_ascii=False))
+
+    async def cdn(request):
+        stats["cdn_requests"] += 1
+        return web.Response(body=blob, content_type="application/octet-stream")
+
+    async def bot_api(request):
+        nonlocal delivered
+        method = request.match_info["method"]
+        form = await request.post()
+        stats["requests"] += 1
+        if args.tg_latency_ms:
+            await asyncio.sleep(args.tg_latency_ms / 1000)
+        if args.p429 and rng.random() < args.p429:
+            stats["429"] += 1
+            return web.json_response({"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                                      "parameters": {"retry_after": 1}}, status=429)
+
+        tags = set()
+        for value in form.values():
+            if hasattr(value, "file"):
+                stats["bytes_uploaded"] += len(value.file.read())
+                tags.update(_MESSAGE_TAG.findall(value.filename or ""))
+            else:
+                tags.update(_MESSAGE_TAG.findall(value))
+        now = time.time()
+        for tag in tags:
+            n = int(tag)
+            entry = arrived.setdefault(n, [0, now])
+            entry[0] += 1
+            entry[1] = now
+            if entry[0] == expected.get(n):
+                delivered += 1
+        if delivered == args.messages:
+            done.set()
+
+        message = {"message_id": stats["requests"], "date": int(now), "chat": {"id": int(form.get("chat_id", 0)), "type": "supergroup"}}
+        result = [message, message] if method == "sendMediaGroup" else message
+        return web.json_response({"ok": True, "result": result})
+
+    app = web.Application(client_max_size=1024 ** 3)
+    app.router.add_get("/cdn/{name}", cdn)
+    app.router.add_post("/bot{token}/{method}", bot_api)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", 0).start()
+    http_port = runner.addresses[0][1]
+    base_url = f"http://127.0.0.1:{http_port}"
+    ws_server = await websockets.serve(max_server, "127.0.0.1", 0, max_size=None)
+    ws_port = next(iter(ws_server.sockets)).getsockname()[1]
+    ready.put((ws_port, http_port))
+
+    try:
+        await asyncio.wait_for(done.wait(), args.timeout)
+    except asyncio.TimeoutError:
+        pass
+
+    latencies = [arrived[n][1] - sent_at[n] for n in expected if n in arrived and arrived[n][0] >= expected[n]]
+    finished = [arrived[n][1] for n in expected if n in arrived and arrived[n][0] >= expected[n]]
+    elapsed = (max(finished) - min(sent_at.values())) if finished else 0.0
+    stats.update({
+        "messages": args.messages,
+        "delivered": len(latencies),
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+    })
+    results.put(stats)
+    ws_server.close()
+    await runner.cleanup()
+
+
+def run_fakes(args, ready, results):
+    asyncio.run(serve_fakes(args, ready, results))
+
+
+async def run_relay(args, ready, results):
+    ws_port, http_port = await asyncio.to_thread(ready.get)
+    os.environ["MAX_WS_URI"] = f"ws://127.0.0.1:{ws_port}"
+    # заглушка Bot API живёт по своему адресу, но лимиты на файлы - как у api.telegram.org, если не --local-api
+    os.environ["TELEGRAM_API_URL"] = f"http://127.0.0.1:{http_port}"
+    os.environ["TELEGRAM_API_LOCAL"] = "true" if args.local_api else "false"
+
+    import main
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    relay = asyncio.create_task(main.main())
+    try:
+        stats = await asyncio.to_thread(results.get, True, args.timeout + 30)
+    finally:
+        relay.cancel()
+        await asyncio.gather(relay, return_exceptions=True)
+
+    scale = 1 if sys.platform == "darwin" else 1024  # ru_maxrss: байты на macOS, килобайты на Linux
+    stats["rss_peak_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 1024 / 1024
+    stats["rss_after_import_mb"] = rss_before * scale / 1024 / 1024
+    stats["relay_429_retries"] = main._telegram_scheduler.retry_after_hits
+    return stats
+
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="maxresender-bench-")
+    accounts = [{"name": f"bench{i}", "token": f"bench-{i}", "telegram_chat_id": str(-1000 - i)} for i in range(args.accounts)]
+    accounts_path = os.path.join(workdir, "accounts.json")
+    with open(accounts_path, "w", encoding="utf-8") as f:
+        json.dump(accounts, f)
+
+    # всё, что можно переопределить из окружения, оставляем как есть: так же меряются и другие настройки
+    os.environ["TELEGRAM_BOT_TOKEN"] = "123456:bench"
+    os.environ["MAX_ACCOUNTS_FILE"] = accounts_path
+    os.environ.setdefault("JOURNAL_PATH", os.path.join(workdir, "journal.sqlite3"))
+    os.environ.setdefault("CACHE_PATH", os.path.join(workdir, "cache.sqlite3"))
+    os.environ.setdefault("FORWARD_SPILL_PATH", os.path.join(workdir, "spill.jsonl"))
+    # настоящие лимиты Bot API (20 сообщений в минуту на чат) превратили бы тест в ожидание
+    os.environ.setdefault("TG_GLOBAL_RATE", "100000")
+    os.environ.setdefault("TG_CHAT_RATE_PER_MINUTE", "6000000")
+    os.environ.setdefault("TG_CHAT_BURST", "1000")
+    os.environ.setdefault("FORWARD_RETRY_DELAY", "1")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+    ctx = multiprocessing.get_context("spawn")
+    ready, results = ctx.Queue(), ctx.Queue()
+    fakes = ctx.Process(target=run_fakes, args=(args, ready, results), name="maxresender-bench-fakes", daemon=True)
+    fakes.start()
+    try:
+        stats = asyncio.run(run_relay(args, ready, results))
+    finally:
+        fakes.join(5)
+        if fakes.is_alive():
+            fakes.terminate()
+
+    if args.json:
+        print(json.dumps(stats, ensure_ascii=False))
+    else:
+        print(
+            f"Доставлено {stats['delivered']}/{stats['messages']} за {stats['elapsed']:.2f} с: "
+            f"{stats['throughput']:.1f} сообщений/с\n"
+            f"Задержка p50 {stats['p50_ms']:.0f} мс, p99 {stats['p99_ms']:.0f} мс, макс. {stats['max_ms']:.0f} мс\n"
+            f"Память: пик {stats['rss_peak_mb']:.0f} MB (после импорта {stats['rss_after_import_mb']:.0f} MB)\n"
+            f"Bot API: запросов {stats['requests']}, ответов 429 {stats['429']}, загружено "
+            f"{stats['bytes_uploaded'] / 1024 / 1024:.1f} MB; запросов к CDN {stats['cdn_requests']}, RPC к Max {stats['rpc']}"
+        )
+
+    failed = stats["delivered"] < stats["messages"]
+    if args.max_p99_ms and stats["p99_ms"] > args.max_p99_ms:
+        failed = True
+    if args.min_throughput and stats["throughput"] < args.min_throughput:
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
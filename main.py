@@ -1,68 +1,740 @@
 import asyncio
+import bisect
+import collections
+import contextlib
+import functools
+import hashlib
+import heapq
+import html
+import importlib
 import json
+import logging
 import os
+import queue
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
 
 import websockets
 from websockets.exceptions import ConnectionClosed
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+from aiogram.methods import SendMediaGroup
 from aiogram.types import (
     InlineKeyboardMarkup, InlineKeyboardButton,
-    InputMediaPhoto, InputMediaVideo, BufferedInputFile
+    InputMediaPhoto, InputMediaVideo, InputFile, FSInputFile
 )
+import aiofiles
 import aiohttp
+import aiohttp.web
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# уровень логов и формат: text, json (одна json-строка на запись) или свой logging.Formatter как "модуль:Класс"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip()
+
+log = logging.getLogger("maxresender")
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна json-строка на запись: время, уровень, текст и всё, что передали в extra (например, account)."""
+
+    _standard = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in self._standard)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    if fmt == "json":
+        formatter = JsonLogFormatter()
+    elif ":" in fmt:
+        module, _, name = fmt.partition(":")
+        formatter = getattr(importlib.import_module(module), name)()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    if not isinstance(logging.getLevelName(level), int):
+        level = "INFO"
+    root.setLevel(level)
+
+
+setup_logging()
+
+
+def _env_int(name, default):
+    raw = os.getenv(name, "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        log.warning(f"Некорректный {name}: {raw}. Используется {default}.")
+        return default
+
+
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 TELEGRAM_CHAT_ID = os.getenv("TELEGRAM_CHAT_ID")
-TELEGRAM_THREAD_ID = os.getenv("TELEGRAM_THREAD_ID")
 ENABLE_SUPERCHATS = os.getenv("ENABLE_SUPERCHATS", "True").lower() == "true"
 
-if TELEGRAM_THREAD_ID and TELEGRAM_THREAD_ID.strip() and ENABLE_SUPERCHATS:
+
+def parse_thread_id(value):
+    value = str(value).strip() if value is not None else ""
+    if not value or not ENABLE_SUPERCHATS:
+        return None
     try:
-        TELEGRAM_THREAD_ID = int(TELEGRAM_THREAD_ID.strip())
+        return int(value)
     except ValueError:
-        print(f"Некорректный TELEGRAM_THREAD_ID: {TELEGRAM_THREAD_ID}. Используется None.")
-        TELEGRAM_THREAD_ID = None
-else:
-    TELEGRAM_THREAD_ID = None
+        log.warning(f"Некорректный TELEGRAM_THREAD_ID: {value}. Используется None.")
+        return None
+
+
+TELEGRAM_THREAD_ID = parse_thread_id(os.getenv("TELEGRAM_THREAD_ID"))
 MAX_TOKEN = os.getenv("MAX_TOKEN")
 MAX_WS_URI = os.getenv("MAX_WS_URI", "wss://ws-api.oneme.ru/websocket")
 MAX_WS_ORIGIN = os.getenv("MAX_WS_ORIGIN", "https://web.max.ru")
 raw_allowed_ids = os.getenv("MAX_ALLOWED_CHAT_IDS", "").split(",")
 MAX_ALLOWED_CHAT_IDS = {cid.strip() for cid in raw_allowed_ids if cid.strip()}
-RECONNECT_DELAY = 5
+# несколько аккаунтов Max в одном процессе: json-файл со списком, см. README
+MAX_ACCOUNTS_FILE = os.getenv("MAX_ACCOUNTS_FILE", "").strip()
+# на сколько процессов раскидать аккаунты (1 - все в этом процессе)
+MAX_PROCESSES = max(_env_int("MAX_PROCESSES", 1), 1)
+# чем разбирать json с вебсокета: auto (orjson, потом msgspec, потом стандартный json), orjson, msgspec, json
+JSON_CODEC = os.getenv("JSON_CODEC", "auto").strip().lower()
+# переподключение к Max: первая попытка сразу, дальше экспоненциально со случайным разбросом, не дольше RECONNECT_MAX_DELAY с
+RECONNECT_BASE_DELAY_MS = max(_env_int("RECONNECT_BASE_DELAY_MS", 500), 1)
+RECONNECT_MAX_DELAY = max(_env_int("RECONNECT_MAX_DELAY", 30), 1)
+# пинги Max (opcode 1 и пинги самого вебсокета): нет ответа за MAX_PING_TIMEOUT с - соединение мёртвое (0 - не пинговать)
+MAX_PING_INTERVAL = max(_env_int("MAX_PING_INTERVAL", 15), 0)
+MAX_PING_TIMEOUT = max(_env_int("MAX_PING_TIMEOUT", 10), 1)
+MAX_CONNECT_TIMEOUT = max(_env_int("MAX_CONNECT_TIMEOUT", 10), 1)
+# держать наготове второе соединение (уже открытое, но без логина), чтобы после обрыва сразу перейти на него
+MAX_STANDBY = os.getenv("MAX_STANDBY", "False").lower() == "true"
+# свой адрес Bot API; TELEGRAM_API_LOCAL=true - это telegram-bot-api --local и файлы до 2ГБ (по умолчанию да,
+# если адрес задан); если он видит нашу файловую систему, TELEGRAM_API_LOCAL_FILES=true отдаёт ему большие файлы
+# путём file://, без выгрузки по сети
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+TELEGRAM_API_LOCAL = bool(TELEGRAM_API_URL) and os.getenv("TELEGRAM_API_LOCAL", "True").lower() == "true"
+TELEGRAM_API_LOCAL_FILES = os.getenv("TELEGRAM_API_LOCAL_FILES", "False").lower() == "true"
+STANDARD_UPLOAD_LIMIT = 50 * 1024 * 1024  # лимит тг - 50МБ
+TELEGRAM_UPLOAD_LIMIT = 2000 * 1024 * 1024 if TELEGRAM_API_LOCAL else STANDARD_UPLOAD_LIMIT
+# файлы больше 50МБ сначала скачиваются сюда, а потом уходят с диска целиком или частями (если лимит 50МБ);
+# больше LARGE_FILE_MAX_MB не качаем вовсе
+LARGE_FILE_SPOOL_DIR = os.getenv("LARGE_FILE_SPOOL_DIR", "").strip() or tempfile.gettempdir()
+LARGE_FILE_MAX_MB = max(_env_int("LARGE_FILE_MAX_MB", 1024), 1)
+SPLIT_PART_SIZE = 49 * 1024 * 1024
+# размер куска при перекачке вложения из Max в Telegram, столько максимум и лежит в памяти на одно вложение
+STREAM_CHUNK_SIZE = max(_env_int("STREAM_CHUNK_SIZE", 64 * 1024), 4 * 1024)
+# сколько вложений одного сообщения и всего бота одновременно резолвим и начинаем качать
+MESSAGE_DOWNLOAD_CONCURRENCY = max(_env_int("MESSAGE_DOWNLOAD_CONCURRENCY", 4), 1)
+GLOBAL_DOWNLOAD_CONCURRENCY = max(_env_int("GLOBAL_DOWNLOAD_CONCURRENCY", 16), 1)
+# сколько файлов одновременно выгружаем в телеграм; файлы больше LARGE_TRANSFER_MB качаются и выгружаются
+# своей отдельной очередью на LARGE_TRANSFER_CONCURRENCY мест, чтобы пара больших видео не держала мелкие фото
+UPLOAD_CONCURRENCY = max(_env_int("UPLOAD_CONCURRENCY", 8), 1)
+LARGE_TRANSFER_MB = max(_env_int("LARGE_TRANSFER_MB", 20), 1)
+LARGE_TRANSFER_CONCURRENCY = max(_env_int("LARGE_TRANSFER_CONCURRENCY", 2), 1)
+# HTTP к CDN Max: пул соединений, лимит на хост, keep-alive и кэш DNS (сек), таймауты (сек, 0 - без общего таймаута)
+HTTP_POOL_SIZE = max(_env_int("HTTP_POOL_SIZE", 100), 1)
+HTTP_PER_HOST = max(_env_int("HTTP_PER_HOST", 16), 0)
+HTTP_KEEPALIVE = max(_env_int("HTTP_KEEPALIVE", 30), 1)
+HTTP_DNS_TTL = max(_env_int("HTTP_DNS_TTL", 300), 0)
+HTTP_CONNECT_TIMEOUT = max(_env_int("HTTP_CONNECT_TIMEOUT", 10), 1)
+HTTP_READ_TIMEOUT = max(_env_int("HTTP_READ_TIMEOUT", 60), 1)
+HTTP_TOTAL_TIMEOUT = max(_env_int("HTTP_TOTAL_TIMEOUT", 0), 0)
+# сколько раз докачивать оборвавшийся файл запросом с Range, и сколько секунд даём на выгрузку файла в телеграм
+DOWNLOAD_RESUME_RETRIES = max(_env_int("DOWNLOAD_RESUME_RETRIES", 3), 0)
+TELEGRAM_UPLOAD_TIMEOUT = max(_env_int("TELEGRAM_UPLOAD_TIMEOUT", 600), 1)
+# очередь входящих сообщений и пул воркеров, которые пересылают их в телеграм
+FORWARD_WORKERS = max(_env_int("FORWARD_WORKERS", 8), 1)
+FORWARD_QUEUE_SIZE = max(_env_int("FORWARD_QUEUE_SIZE", 1000), 1)
+FORWARD_OVERFLOW = os.getenv("FORWARD_OVERFLOW", "block").strip().lower()
+FORWARD_SPILL_PATH = os.getenv("FORWARD_SPILL_PATH", "forward_spill.jsonl")
+# буфер приёма перед очередью: вебсокет читается всегда, при block ждут здесь; сверх лимита новые выкидываются
+FORWARD_INTAKE_SIZE = max(_env_int("FORWARD_INTAKE_SIZE", 10000), 1)
+FORWARD_STATS_INTERVAL = _env_int("FORWARD_STATS_INTERVAL", 0)
+# лимиты Bot API: ~30 сообщений в секунду на бота и ~20 в минуту в одну группу
+TG_GLOBAL_RATE = max(_env_int("TG_GLOBAL_RATE", 30), 1)
+TG_CHAT_RATE_PER_MINUTE = max(_env_int("TG_CHAT_RATE_PER_MINUTE", 20), 1)
+TG_CHAT_BURST = max(_env_int("TG_CHAT_BURST", 5), 1)
+TG_SEND_RETRIES = max(_env_int("TG_SEND_RETRIES", 5), 0)
+# неизвестные имена копим столько миллисекунд и спрашиваем у Max одним запросом
+NAME_BATCH_WINDOW_MS = max(_env_int("NAME_BATCH_WINDOW_MS", 20), 0)
+NAME_BATCH_SIZE = max(_env_int("NAME_BATCH_SIZE", 100), 1)
+# журнал входящих сообщений: пишем до постановки в очередь, отмечаем после отправки (пустой путь - без журнала)
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "maxresender_journal.sqlite3").strip()
+JOURNAL_COMMIT_MS = max(_env_int("JOURNAL_COMMIT_MS", 20), 1)
+JOURNAL_BATCH_SIZE = max(_env_int("JOURNAL_BATCH_SIZE", 200), 1)
+JOURNAL_KEEP_SECONDS = max(_env_int("JOURNAL_KEEP_SECONDS", 24 * 3600), 0)
+# сколько раз пробовать доставить сообщение, если телеграм недоступен, и пауза между попытками
+FORWARD_MAX_ATTEMPTS = max(_env_int("FORWARD_MAX_ATTEMPTS", 10), 1)
+FORWARD_RETRY_DELAY = max(_env_int("FORWARD_RETRY_DELAY", 30), 0)
+# склейка коротких текстов одного чата в одно сообщение: сколько ждать следующих (0 - не склеивать),
+# сколько сообщений и символов максимум в одной склейке (телеграм пропускает до 4096)
+COALESCE_WINDOW_MS = max(_env_int("COALESCE_WINDOW_MS", 0), 0)
+COALESCE_MAX_MESSAGES = max(_env_int("COALESCE_MAX_MESSAGES", 20), 1)
+COALESCE_MAX_CHARS = min(max(_env_int("COALESCE_MAX_CHARS", 4096), 256), 4096)
+# таймауты ответов Max по opcode в секундах, формат "32:5,49:10", остальным RPC_DEFAULT_TIMEOUT
+RPC_DEFAULT_TIMEOUT = max(_env_int("RPC_DEFAULT_TIMEOUT", 5), 1)
+RPC_TIMEOUTS = {32: 5, 49: 10, 83: 5, 88: 5}
+for _item in os.getenv("RPC_TIMEOUTS", "").split(","):
+    _opcode, _, _timeout = _item.partition(":")
+    try:
+        RPC_TIMEOUTS[int(_opcode)] = float(_timeout)
+    except ValueError:
+        if _item.strip():
+            log.warning(f"Некорректный элемент RPC_TIMEOUTS: {_item}")
+# догонялка пропущенного после реконнекта: сколько сообщений на чат, за какой срок, сколько чатов разом
+BACKFILL_MAX_MESSAGES = max(_env_int("BACKFILL_MAX_MESSAGES", 100), 0)
+BACKFILL_MAX_AGE = max(_env_int("BACKFILL_MAX_AGE", 24 * 3600), 0)
+BACKFILL_CONCURRENCY = max(_env_int("BACKFILL_CONCURRENCY", 2), 1)
+BACKFILL_REQUEST_DELAY_MS = max(_env_int("BACKFILL_REQUEST_DELAY_MS", 500), 0)
+# file_id уже загруженных в телеграм вложений, чтобы одно и то же не качать и не грузить заново
+MEDIA_CACHE_TTL = max(_env_int("MEDIA_CACHE_TTL", 30 * 24 * 3600), 0)
+# дисковый кэш скачанных файлов (пустой путь - не нужен, качаем потоком прямо в телеграм)
+MEDIA_BLOB_DIR = os.getenv("MEDIA_BLOB_DIR", "").strip()
+MEDIA_BLOB_MAX_MB = max(_env_int("MEDIA_BLOB_MAX_MB", 512), 1)
+# правила маршрутизации: какие сообщения Max в какие чаты и темы телеграма (json, см. README)
+ROUTES_FILE = os.getenv("ROUTES_FILE", "").strip()
+# как часто проверять, не поменялся ли файл маршрутов, секунды (0 - не перечитывать)
+ROUTES_RELOAD_INTERVAL = max(_env_int("ROUTES_RELOAD_INTERVAL", 5), 0)
+# метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - не поднимать), у шардов порт +номер шарда
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = max(_env_int("METRICS_PORT", 0), 0)
+# кэш имён, названий чатов и ссылок на файлы: в памяти LRU, на диске sqlite (пустой путь - только память)
+CACHE_PATH = os.getenv("CACHE_PATH", "maxresender_cache.sqlite3").strip()
+CACHE_MAX_ENTRIES = max(_env_int("CACHE_MAX_ENTRIES", 10000), 1)
+CACHE_TTL = {
+    "name": _env_int("CACHE_NAME_TTL", 7 * 24 * 3600),
+    "chat": _env_int("CACHE_CHAT_TTL", 24 * 3600),
+    # ссылки CDN протухают, долго их держать нельзя
+    "file": _env_int("CACHE_URL_TTL", 30 * 60),
+    "video": _env_int("CACHE_URL_TTL", 30 * 60),
+    # последнее увиденное сообщение чата: старше BACKFILL_MAX_AGE догонять уже не будем
+    "seen": BACKFILL_MAX_AGE,
+    "tg_file": MEDIA_CACHE_TTL,
+    "blob": MEDIA_CACHE_TTL,
+}
+if FORWARD_OVERFLOW not in ("block", "drop_oldest", "spill"):
+    log.warning(f"Некорректный FORWARD_OVERFLOW: {FORWARD_OVERFLOW}. Используется block.")
+    FORWARD_OVERFLOW = "block"
 
 if not TELEGRAM_BOT_TOKEN:
     raise RuntimeError("Укажите TELEGRAM_BOT_TOKEN в .env")
-if not TELEGRAM_CHAT_ID:
-    raise RuntimeError("Укажите TELEGRAM_CHAT_ID в .env")
-if not MAX_TOKEN:
-    raise RuntimeError("Укажите MAX_TOKEN в .env")
+if not MAX_ACCOUNTS_FILE:
+    if not TELEGRAM_CHAT_ID:
+        raise RuntimeError("Укажите TELEGRAM_CHAT_ID в .env")
+    if not MAX_TOKEN:
+        raise RuntimeError("Укажите MAX_TOKEN в .env")
 
-if not MAX_ALLOWED_CHAT_IDS:
-    print("Укажите MAX_ALLOWED_CHAT_IDS в .env (через запятую), чтобы пересылать сообщения только из нужных групп.")
+    if not MAX_ALLOWED_CHAT_IDS:
+        log.warning("Укажите MAX_ALLOWED_CHAT_IDS в .env (через запятую), чтобы пересылать сообщения только из нужных групп.")
 
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
-_seq = 100
-_dispatcher = {}  # {seq: asyncio.Future}
-_session = None
-_name_cache = {}  # {user_id: name}
 
-def next_seq():
-    global _seq
-    _seq += 1
-    return _seq
+
+def load_json_codec(name):
+    """Возвращает (название, loads, dumps). dumps отдаёт str, чтобы вебсокет слал текстовый кадр."""
+    if name in ("auto", "orjson"):
+        try:
+            import orjson
+            return "orjson", orjson.loads, lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+        except ImportError:
+            if name == "orjson":
+                log.warning("orjson не установлен, пробуем другой json")
+    if name in ("auto", "orjson", "msgspec"):
+        try:
+            import msgspec
+            decoder = msgspec.json.Decoder()
+            encoder = msgspec.json.Encoder()
+            return "msgspec", decoder.decode, lambda obj: encoder.encode(obj).decode()
+        except ImportError:
+            if name == "msgspec":
+                log.warning("msgspec не установлен, используется стандартный json")
+    elif name != "json":
+        log.warning(f"Некорректный JSON_CODEC: {name}. Используется auto.")
+        return load_json_codec("auto")
+    return "json", json.loads, lambda obj: json.dumps(obj, ensure_ascii=False)
+
+
+JSON_CODEC, json_loads, json_dumps = load_json_codec(JSON_CODEC)
+
+# куда в телеграме слать: чат и тема супергруппы (None - общая тема)
+Target = collections.namedtuple("Target", "chat_id thread_id")
+DEFAULT_TARGET = Target(TELEGRAM_CHAT_ID, TELEGRAM_THREAD_ID)
+
+
+class DeliveryFailed(Exception):
+    """Сообщение надо доставить позже: телеграм не принял запрос после всех повторов (сеть, 5xx, 429)
+    или соединение с Max оборвалось, пока спрашивали ссылку на вложение."""
+
+
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}  # {значения меток: число}
+
+    def inc(self, *labels, amount=1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.type}"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_metric_labels(self.labels, labels)} {value}"
+
+
+class Gauge(Counter):
+    """Значение выставляется перед каждым снятием метрик (см. collect_gauges)."""
+
+    type = "gauge"
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values = {}  # {значения меток: [попадания по корзинам..., сумма, количество]}
+
+    def observe(self, value, *labels):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = [0] * len(self.buckets) + [0.0, 0]
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            entry[i] += 1
+        entry[-2] += value
+        entry[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, entry in self._values.items():
+            total = 0
+            for bound, hits in zip(self.buckets, entry):
+                total += hits
+                yield f"{self.name}_bucket{_metric_labels(self.labels + ('le',), labels + (bound,))} {total}"
+            yield f"{self.name}_bucket{_metric_labels(self.labels + ('le',), labels + ('+Inf',))} {entry[-1]}"
+            yield f"{self.name}_sum{_metric_labels(self.labels, labels)} {entry[-2]}"
+            yield f"{self.name}_count{_metric_labels(self.labels, labels)} {entry[-1]}"
+
+
+_SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))  # 1KB ... 256MB
+
+FRAMES = Counter("maxresender_frames_total", "Кадры от Max по opcode", ("account", "opcode"))
+FORWARDED = Counter("maxresender_messages_forwarded_total", "Сообщения, пересланные в телеграм", ("account",))
+COALESCED = Counter("maxresender_messages_coalesced_total", "Сообщения, ушедшие в телеграм в составе склейки", ("account",))
+RECONNECTS = Counter("maxresender_reconnects_total", "Переподключения к Max", ("account",))
+FORWARD_FAILED = Counter("maxresender_messages_failed_total", "Сообщения, которые так и не удалось переслать", ("account",))
+FORWARD_LATENCY = Histogram(
+    "maxresender_forward_latency_seconds", "От получения сообщения из Max до конца отправки в телеграм", ("account",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+)
+RPC_TIME = Histogram("maxresender_rpc_seconds", "Время ответа Max на запрос", ("opcode",))
+RPC_TIMEOUTS_TOTAL = Counter("maxresender_rpc_timeouts_total", "Запросы к Max без ответа", ("opcode",))
+DOWNLOAD_TIME = Histogram("maxresender_download_seconds", "Время скачивания вложения из Max (вместе с выгрузкой в телеграм, если она потоком)")
+DOWNLOAD_BYTES = Histogram("maxresender_download_bytes", "Размер скачанных вложений", buckets=_SIZE_BUCKETS)
+TELEGRAM_TIME = Histogram("maxresender_telegram_send_seconds", "Время запроса к Bot API", ("method",))
+TELEGRAM_RETRIES = Counter("maxresender_telegram_retries_total", "Повторы запросов к Bot API", ("reason",))
+TELEGRAM_FAILED = Counter("maxresender_telegram_failed_total", "Запросы к Bot API, не прошедшие после всех повторов", ("method",))
+RPC_IN_FLIGHT = Gauge("maxresender_rpc_in_flight", "Запросы к Max, ждущие ответа", ("account",))
+QUEUE_DEPTH = Gauge("maxresender_forward_queue_depth", "Сообщения в очереди пересылки", ("account",))
+QUEUE_SPILLED = Gauge("maxresender_forward_spilled", "Сообщения, ждущие в файле переполнения", ("account",))
+QUEUE_DROPPED = Gauge("maxresender_forward_dropped", "Сообщения, выброшенные при переполнении", ("account",))
+BUSY_WORKERS = Gauge("maxresender_forward_busy_workers", "Воркеры пересылки, занятые сообщением", ("account",))
+DOWNLOADS_IN_FLIGHT = Gauge("maxresender_downloads_in_flight", "Вложения, которые сейчас резолвятся и качаются")
+UPLOADS_IN_FLIGHT = Gauge("maxresender_uploads_in_flight", "Файлы, которые сейчас выгружаются в телеграм")
+TASKS = Gauge("maxresender_asyncio_tasks", "Задачи asyncio в процессе")
+MEDIA_CACHE = Gauge("maxresender_media_cache", "Счётчики кэша вложений", ("result",))
+METRICS = (
+    FRAMES, FORWARDED, FORWARD_FAILED, FORWARD_LATENCY, RPC_TIME, RPC_TIMEOUTS_TOTAL, DOWNLOAD_TIME, DOWNLOAD_BYTES,
+    TELEGRAM_TIME, TELEGRAM_RETRIES, TELEGRAM_FAILED, RPC_IN_FLIGHT, QUEUE_DEPTH, QUEUE_SPILLED, QUEUE_DROPPED,
+    BUSY_WORKERS, DOWNLOADS_IN_FLIGHT, UPLOADS_IN_FLIGHT, TASKS, MEDIA_CACHE, COALESCED, RECONNECTS,
+)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # токенов в секунду
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    async def acquire(self, cost=1):
+        """Ждёт, пока накопится cost токенов, и возвращает, сколько секунд прождали."""
+        cost = min(cost, self.capacity)
+        waited = 0.0
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                # токены начинают копиться только после паузы
+                self.updated = self.paused_until
+                delay = self.paused_until - now
+            else:
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return waited
+                delay = (cost - self.tokens) / self.rate
+            await asyncio.sleep(delay)
+            waited += delay
+
+
+class TelegramScheduler(BaseRequestMiddleware):
+    """Через него идёт каждый запрос к Bot API.
+
+    Держит общий и поканальный token bucket, на TelegramRetryAfter ставит на паузу bucket этого чата
+    и повторяет запрос с джиттером, сетевые и 5xx ошибки тоже повторяет с экспоненциальной задержкой.
+    """
+
+    def __init__(self):
+        self.global_bucket = TokenBucket(TG_GLOBAL_RATE, TG_GLOBAL_RATE)
+        self.chat_buckets = {}  # {chat_id: TokenBucket}
+        # при MAX_PROCESSES > 1 лимиты бота делятся между процессами, см. share()
+        self.processes = 1
+        self.chat_shares = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.retry_after_hits = 0
+        self.send_time = 0.0
+        self.send_time_max = 0.0
+        self.throttle_time = 0.0
+
+    def share(self, processes, chat_shares):
+        """Лимиты телеграма считаются на токен бота, а не на процесс: берём свою долю.
+
+        Общий лимит делится на processes, поканальный - на число процессов, шлющих в этот чат
+        (chat_shares; чатов, которых там нет, например из маршрутов, - на все processes).
+        """
+        self.processes = processes
+        self.chat_shares = chat_shares
+        rate = TG_GLOBAL_RATE / processes
+        self.global_bucket = TokenBucket(rate, max(rate, 1))
+        self.chat_buckets.clear()
+
+    def chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            share = self.chat_shares.get(chat_id, self.processes)
+            bucket = self.chat_buckets[chat_id] = TokenBucket(TG_CHAT_RATE_PER_MINUTE / 60 / share, max(TG_CHAT_BURST / share, 1))
+        return bucket
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        bucket = self.chat_bucket(str(chat_id)) if chat_id is not None else None
+        # альбом телеграм считает как несколько сообщений
+        cost = len(method.media) if isinstance(method, SendMediaGroup) else 1
+
+        attempt = 0
+        while True:
+            waited = await self.global_bucket.acquire(cost)
+            if bucket is not None:
+                waited += await bucket.acquire(cost)
+            self.throttle_time += waited
+
+            started = time.monotonic()
+            try:
+                response = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                error = e
+                self.retry_after_hits += 1
+                TELEGRAM_RETRIES.inc("retry_after")
+                (bucket or self.global_bucket).pause(e.retry_after)
+                delay = random.uniform(0, 1)
+                log.warning(f"Телеграм просит подождать {e.retry_after} с ({method.__api_method__})")
+            except (TelegramNetworkError, TelegramServerError) as e:
+                error = e
+                delay = min(2 ** attempt, 30) + random.uniform(0, 1)
+                TELEGRAM_RETRIES.inc("network")
+                log.warning(f"Ошибка сети при запросе {method.__api_method__}: {e}. Повтор через {delay:.1f} с")
+            else:
+                elapsed = time.monotonic() - started
+                self.sent += 1
+                self.send_time += elapsed
+                self.send_time_max = max(self.send_time_max, elapsed)
+                TELEGRAM_TIME.observe(elapsed, method.__api_method__)
+                return response
+
+            attempt += 1
+            if attempt > TG_SEND_RETRIES:
+                self.failed += 1
+                TELEGRAM_FAILED.inc(method.__api_method__)
+                raise DeliveryFailed(f"{method.__api_method__}: {error}") from error
+            self.retries += 1
+            await asyncio.sleep(delay)
+            self.throttle_time += delay
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retries": self.retries,
+            "retry_after": self.retry_after_hits,
+            "send_time_avg": self.send_time / self.sent if self.sent else 0.0,
+            "send_time_max": self.send_time_max,
+            "throttle_time": self.throttle_time,
+        }
+
+    def report(self):
+        s = self.stats()
+        return (
+            f"Telegram: отправлено {s['sent']}, не отправлено {s['failed']}, повторов {s['retries']} "
+            f"(из них 429: {s['retry_after']}), время отправки ср. {s['send_time_avg']:.2f} с / макс. "
+            f"{s['send_time_max']:.2f} с, ожидание лимитов всего {s['throttle_time']:.1f} с"
+        )
+
+
+class Cache:
+    """LRU в памяти поверх sqlite на диске, у каждого вида записей (kind) свой TTL из CACHE_TTL.
+
+    В памяти держим не больше max_entries записей. На диск пишет отдельный поток пачками, цикл событий
+    только кладёт запись в очередь; чтение с диска - только при промахе памяти и с коротким busy timeout.
+    Любая ошибка sqlite - просто промах (или непостоянная запись), кэш работает дальше из памяти.
+    Протухшие записи на диске чистятся при старте и раз в час.
+    """
+
+    def __init__(self, path=CACHE_PATH, max_entries=CACHE_MAX_ENTRIES, ttl=CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._memory = collections.OrderedDict()  # {(kind, key): (value, expires)}, value None - удалено
+        self._db = None  # только для чтения, из цикла событий
+        self._writes = queue.SimpleQueue()  # (sql, rows) для потока записи, None - остановиться
+        self._writer = None
+        if path:
+            try:
+                # шарды с общим CACHE_PATH не должны держать друг друга: не дождались - промах
+                self._db = sqlite3.connect(path, timeout=0.1)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS cache ("
+                    "kind TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, expires REAL NOT NULL, "
+                    "PRIMARY KEY (kind, key))"
+                )
+                self._db.commit()
+            except sqlite3.Error as e:
+                log.warning(f"Не удалось открыть кэш {path}: {e}. Кэш будет только в памяти.")
+                self._db = None
+            else:
+                self._writer = threading.Thread(target=self._write_loop, args=(path,), name="cache-writer", daemon=True)
+                self._writer.start()
+
+    def get(self, kind, key):
+        key = str(key)
+        now = time.time()
+        item = self._memory.get((kind, key))
+        if item is not None:
+            if item[1] > now:
+                self._memory.move_to_end((kind, key))
+                return item[0]
+            del self._memory[(kind, key)]
+        if self._db is None:
+            return None
+        try:
+            row = self._db.execute(
+                "SELECT value, expires FROM cache WHERE kind = ? AND key = ? AND expires > ?", (kind, key, now)
+            ).fetchone()
+        except sqlite3.Error as e:
+            log.debug(f"Кэш на диске недоступен: {e}")
+            return None
+        if row is None:
+            return None
+        self._remember(kind, key, row[0], row[1])
+        return row[0]
+
+    def set(self, kind, key, value):
+        self.set_many(kind, [(key, value)])
+
+    def set_many(self, kind, items):
+        """Как set, но одной транзакцией на все пары (key, value)."""
+        expires = time.time() + self.ttl.get(kind, 3600)
+        rows = []
+        for key, value in items:
+            self._remember(kind, str(key), value, expires)
+            rows.append((kind, str(key), value, expires))
+        if self._writer is not None and rows:
+            self._writes.put(("INSERT OR REPLACE INTO cache (kind, key, value, expires) VALUES (?, ?, ?, ?)", rows))
+
+    def delete(self, kind, key):
+        key = str(key)
+        if self._writer is None:
+            self._memory.pop((kind, key), None)
+            return
+        # пока поток записи не дошёл до удаления, чтение с диска вернуло бы старое значение
+        self._remember(kind, key, None, time.time() + 60)
+        self._writes.put(("DELETE FROM cache WHERE kind = ? AND key = ?", [(kind, key)]))
+
+    def close(self):
+        if self._writer is not None:
+            self._writes.put(None)
+            self._writer.join(timeout=5)
+            self._writer = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _remember(self, kind, key, value, expires):
+        self._memory[(kind, key)] = (value, expires)
+        self._memory.move_to_end((kind, key))
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _write_loop(self, path):
+        try:
+            db = sqlite3.connect(path)
+            db.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            log.warning(f"Не удалось открыть кэш {path} на запись: {e}. Новые записи будут только в памяти.")
+            return
+        pruned_at = 0.0
+        stop = False
+        while not stop:
+            # всё, что накопилось, пока писали прошлую пачку, - одной транзакцией
+            ops = [self._writes.get()]
+            while True:
+                try:
+                    ops.append(self._writes.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in ops
+            try:
+                with db:
+                    for op in ops:
+                        if op is not None:
+                            db.executemany(*op)
+                    if time.monotonic() - pruned_at > 3600:
+                        pruned_at = time.monotonic()
+                        db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+            except sqlite3.Error as e:
+                log.warning(f"Не удалось записать кэш на диск ({len(ops)} записей): {e}")
+        db.close()
+
+
+if TELEGRAM_API_URL:
+    bot = Bot(
+        token=TELEGRAM_BOT_TOKEN,
+        session=AiohttpSession(
+            api=TelegramAPIServer.from_base(TELEGRAM_API_URL, is_local=TELEGRAM_API_LOCAL_FILES),
+            limit=HTTP_POOL_SIZE
+        )
+    )
+else:
+    bot = Bot(token=TELEGRAM_BOT_TOKEN, session=AiohttpSession(limit=HTTP_POOL_SIZE))
+_telegram_scheduler = TelegramScheduler()
+bot.session.middleware(_telegram_scheduler)
+_session = None
+_cache = Cache()
+_download_slots = asyncio.Semaphore(GLOBAL_DOWNLOAD_CONCURRENCY)
+_large_download_slots = asyncio.Semaphore(LARGE_TRANSFER_CONCURRENCY)
+_upload_slots = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+_large_upload_slots = asyncio.Semaphore(LARGE_TRANSFER_CONCURRENCY)
 
 async def get_session():
     global _session
     if _session is None or _session.closed:
-        _session = aiohttp.ClientSession()
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_SIZE,
+            limit_per_host=HTTP_PER_HOST,
+            keepalive_timeout=HTTP_KEEPALIVE,
+            ttl_dns_cache=HTTP_DNS_TTL or None,
+            use_dns_cache=HTTP_DNS_TTL > 0
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=HTTP_TOTAL_TIMEOUT or None,
+            connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
     return _session
 
 
+def transfer_slots(size, small, large):
+    """Файлы больше LARGE_TRANSFER_MB идут через large, остальные (и неизвестного размера) через small."""
+    if size is not None and size > LARGE_TRANSFER_MB * 1024 * 1024:
+        return large
+    return small
+
+
+async def iter_download(url, resp, chunk_size=STREAM_CHUNK_SIZE):
+    """Тело ответа кусками. Если соединение оборвалось, докачивает остаток запросом с Range.
+
+    Закрывает ответ сам, в том числе когда читающий бросил чтение на середине (через contextlib.aclosing).
+    """
+    size = resp.content_length
+    started = time.monotonic()
+    received = 0
+    retries = 0
+    try:
+        while True:
+            try:
+                async for chunk in resp.content.iter_chunked(chunk_size):
+                    received += len(chunk)
+                    yield chunk
+                if size is None or received >= size:
+                    break
+                raise aiohttp.ClientPayloadError(f"получено {received} из {size} байт")
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                retries += 1
+                if retries > DOWNLOAD_RESUME_RETRIES:
+                    raise
+                log.warning(f"Скачивание {url} оборвалось на {received} байтах ({e!r}), докачиваем")
+                resp.close()
+                session = await get_session()
+                # ничего ещё не отдали - можно просто начать заново
+                headers = {"Range": f"bytes={received}-"} if received else None
+                resp = await session.get(url, headers=headers)
+                if resp.status != (206 if received else 200):
+                    raise
+    finally:
+        resp.close()
+    DOWNLOAD_TIME.observe(time.monotonic() - started)
+    DOWNLOAD_BYTES.observe(received)
+
+
 
 def build_keyboard(sender_name=None, chat_name=None):
     if sender_name:
@@ -77,449 +749,2454 @@ def build_keyboard(sender_name=None, chat_name=None):
     return None
 
 
-async def get_file_url(websocket, file_id, chat_id, message_id):
-    seq = next_seq()
-    s_seq = str(seq)
-    future = asyncio.get_running_loop().create_future()
-    _dispatcher[s_seq] = future
-    
-    request = {
-        "ver": 11,
-        "cmd": 0,
-        "seq": seq,
-        "opcode": 88,
-        "payload": {
-            "fileId": file_id,
-            "chatId": int(chat_id),
-            "messageId": str(message_id)
+class MaxClient:
+    """Запросы к Max поверх одного вебсокета.
+
+    У каждого соединения свой seq и своя таблица ожидающих ответов: при обрыве close() сразу роняет
+    все ожидающие запросы, а не оставляет их досиживать таймаут.
+    """
+
+    def __init__(self, websocket, account, first_seq=100):
+        self.websocket = websocket
+        self.account = account
+        self.closed = False
+        self._seq = first_seq
+        self._pending = {}  # {seq: future}
+
+    def next_seq(self):
+        self._seq += 1
+        return self._seq
+
+    async def request(self, opcode, payload, timeout=None):
+        if self.closed:
+            raise ConnectionError("соединение с Max закрыто")
+        seq = self.next_seq()
+        future = asyncio.get_running_loop().create_future()
+        self._pending[str(seq)] = future
+        request = {
+            "ver": 11,
+            "cmd": 0,
+            "seq": seq,
+            "opcode": opcode,
+            "payload": payload
         }
+        started = time.monotonic()
+        try:
+            try:
+                await self.websocket.send(json_dumps(request))
+            except ConnectionClosed as e:
+                # сокет уже мёртв, а читатель ещё не заметил: для вызывающих это тот же обрыв
+                raise ConnectionError(f"соединение с Max оборвалось: {e}") from e
+            if timeout is None:
+                timeout = RPC_TIMEOUTS.get(opcode, RPC_DEFAULT_TIMEOUT)
+            response = await asyncio.wait_for(future, timeout=timeout)
+            RPC_TIME.observe(time.monotonic() - started, opcode)
+            return response
+        except asyncio.TimeoutError:
+            RPC_TIMEOUTS_TOTAL.inc(opcode)
+            raise asyncio.TimeoutError(f"Max не ответил на opcode {opcode} за {timeout} с") from None
+        finally:
+            self._pending.pop(str(seq), None)
+
+    async def gather(self, *calls):
+        """Пачка запросов (opcode, payload) разом на одном сокете. Ошибки возвращаются на месте результата."""
+        return await asyncio.gather(*(self.request(opcode, payload) for opcode, payload in calls), return_exceptions=True)
+
+    def dispatch(self, data):
+        """Если это ответ на наш запрос, отдаёт его ждущему и возвращает True."""
+        msg_seq = data.get("seq")
+        if msg_seq is None:
+            return False
+        future = self._pending.get(str(msg_seq))
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(data)
+        return True
+
+    def expects(self, seq):
+        """Ждём ли ответ с таким seq (seq как есть из кадра, строкой или числом)."""
+        return seq is not None and str(seq) in self._pending
+
+    def close(self):
+        self.closed = True
+        pending, self._pending = self._pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("соединение с Max оборвалось"))
+
+    @property
+    def in_flight(self):
+        return len(self._pending)
+
+
+async def get_file_url(client, file_id, chat_id, message_id):
+    cached = _cache.get("file", file_id)
+    if cached:
+        return cached
+
+    payload = {
+        "fileId": file_id,
+        "chatId": int(chat_id),
+        "messageId": str(message_id)
     }
     try:
-        await websocket.send(json.dumps(request))
-        data = await asyncio.wait_for(future, timeout=5.0)
-        return data.get("payload", {}).get("url")
+        data = await client.request(88, payload)
+        url = data.get("payload", {}).get("url")
+        if url:
+            _cache.set("file", file_id, url)
+        return url
+    except (ConnectionError, asyncio.TimeoutError) as e:
+        # соединение оборвалось или Max молчит - повторим сообщение целиком через новое соединение
+        raise DeliveryFailed(f"не получили ссылку на файл: {e}") from e
     except Exception as e:
-        print(f"Ошибка при ожидании ссылки на файл: {e}")
+        log.warning(f"Ошибка при ожидании ссылки на файл: {e}")
         return None
-    finally:
-        _dispatcher.pop(s_seq, None)
 
 
-async def get_video_url(websocket, video_id, chat_id, message_id):
-    seq = next_seq()
-    s_seq = str(seq)
-    future = asyncio.get_running_loop().create_future()
-    _dispatcher[s_seq] = future
-    
-    request = {
-        "ver": 11,
-        "cmd": 0,
-        "seq": seq,
-        "opcode": 83,
-        "payload": {
-            "videoId": video_id,
-            "chatId": int(chat_id),
-            "messageId": str(message_id)
-        }
+async def get_video_url(client, video_id, chat_id, message_id):
+    cached = _cache.get("video", video_id)
+    if cached:
+        return cached
+
+    payload = {
+        "videoId": video_id,
+        "chatId": int(chat_id),
+        "messageId": str(message_id)
     }
     try:
-        await websocket.send(json.dumps(request))
-        data = await asyncio.wait_for(future, timeout=5.0)
+        data = await client.request(83, payload)
         payload = data.get("payload", {})
+        url = None
         # пробуем разные качества хз мб подойдет
         for quality in ["MP4_720", "MP4_480", "MP4_360", "MP4_1080"]:
             if quality in payload:
-                return payload[quality]
-        # резервный поиск любой ссылки
-        for val in payload.values():
-            if isinstance(val, str) and val.startswith("http"):
-                return val
-        return None
+                url = payload[quality]
+                break
+        else:
+            # резервный поиск любой ссылки
+            for val in payload.values():
+                if isinstance(val, str) and val.startswith("http"):
+                    url = val
+                    break
+        if url:
+            _cache.set("video", video_id, url)
+        return url
+    except (ConnectionError, asyncio.TimeoutError) as e:
+        raise DeliveryFailed(f"не получили ссылку на видео: {e}") from e
     except Exception as e:
-        print(f"Ошибка при ожидании ссылки на видео: {e}")
+        log.warning(f"Ошибка при ожидании ссылки на видео: {e}")
         return None
-    finally:
-        _dispatcher.pop(s_seq, None)
 
 
 
-async def send_to_telegram(text, sender_name=None, chat_name=None, escape=True):
+async def send_to_telegram(text, sender_name=None, chat_name=None, escape=True, target=DEFAULT_TARGET):
     clean_text = (text or "").strip()
     
     if not clean_text:
         final_text = "<i>(пустое сообщение)</i>"
     else:
         if escape:
-            final_text = clean_text.replace("<", "&lt;").replace(">", "&gt;")
+            final_text = html.escape(clean_text, quote=False)
         else:
             final_text = clean_text
 
     kb = build_keyboard(sender_name, chat_name)
     try:
         await bot.send_message(
-            chat_id=TELEGRAM_CHAT_ID,
+            chat_id=target.chat_id,
             text=final_text,
             parse_mode=ParseMode.HTML,
             reply_markup=kb,
-            message_thread_id=TELEGRAM_THREAD_ID
+            message_thread_id=target.thread_id
         )
+    except DeliveryFailed:
+        raise
     except Exception as e:
-        print(f"Ошибка при отправке в Telegram: {e}")
+        log.warning(f"Ошибка при отправке в Telegram: {e}")
+
+
+async def deliver_all(sends):
+    """Отправки в разные цели параллельно. DeliveryFailed пробрасываем (сообщение повторится), прочие ошибки логируем."""
+    results = await asyncio.gather(*sends, return_exceptions=True)
+    for result in results:
+        if isinstance(result, DeliveryFailed):
+            raise result
+    for result in results:
+        if isinstance(result, BaseException):
+            log.warning(f"Ошибка при отправке в Telegram: {result}")
+    return results
+
+
+class FileTooLarge(Exception):
+    def __init__(self, size):
+        super().__init__(f"файл больше лимита телеграма ({size} байт)")
+        self.size = size
+
+
+class TooLargeForAlbum(Exception):
+    """Элемент альбома больше лимита выгрузки: он уходит отдельно после альбома (частями, если надо)."""
+
+
+class FilePartInputFile(InputFile):
+    """Кусок файла с диска: offset и length байт. Повторная отправка просто перечитывает его."""
+
+    def __init__(self, path, filename, offset, length, chunk_size=STREAM_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.path = path
+        self.offset = offset
+        self.length = length
+        self.size = length
+
+    async def read(self, bot):
+        async with aiofiles.open(self.path, "rb") as f:
+            await f.seek(self.offset)
+            left = self.length
+            while left > 0:
+                chunk = await f.read(min(self.chunk_size, left))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                yield chunk
+
+
+class SpooledFile:
+    """Вложение больше 50МБ (или без Content-Length), скачанное целиком в LARGE_FILE_SPOOL_DIR. close() удаляет файл."""
+
+    def __init__(self, path, filename, size, url):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.url = url
+
+    def input_file(self):
+        if TELEGRAM_API_LOCAL_FILES:
+            return f"file://{os.path.abspath(self.path)}"
+        return FilePartInputFile(self.path, self.filename, 0, self.size)
+
+    def parts(self, part_size=SPLIT_PART_SIZE):
+        """(номер, всего, кусок) для отправки частями: name.001, name.002, ... - склеиваются через cat."""
+        count = -(-self.size // part_size)
+        for i in range(count):
+            offset = i * part_size
+            name = f"{self.filename}.{i + 1:03d}"
+            yield i + 1, count, FilePartInputFile(self.path, name, offset, min(part_size, self.size - offset))
+
+    def close(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+async def spool_large(input_file):
+    """Докачивает открытый StreamingInputFile во временный файл. Память - один кусок, запись - в потоках aiofiles."""
+    input_file.limit = LARGE_FILE_MAX_MB * 1024 * 1024
+    fd, path = tempfile.mkstemp(prefix="maxresender-", suffix=".part", dir=LARGE_FILE_SPOOL_DIR)
+    os.close(fd)
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            async for chunk in input_file.read(bot):
+                await f.write(chunk)
+    except BaseException:
+        os.remove(path)
+        raise
+    finally:
+        input_file.close()
+    return SpooledFile(path, input_file.filename, os.path.getsize(path), input_file.url)
+
+
+class StreamingInputFile(InputFile):
+    """Вложение, которое качается из Max кусками прямо во время загрузки в Telegram.
+
+    Первый read() дочитывает уже открытый ответ (заголовки которого проверили в open_attachment),
+    повторные (например, ретрай кружка как обычного видео) заново скачивают файл по ссылке.
+    """
+
+    def __init__(self, url, filename, resp=None, chunk_size=STREAM_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.url = url
+        self.size = resp.content_length if resp is not None else None
+        self.limit = TELEGRAM_UPLOAD_LIMIT
+        self._resp = resp
+        self._slot = None
+
+    def hold(self, slot):
+        """Место в очереди скачиваний (семафор) отпускается, когда тело дочитано или файл закрыт."""
+        self._slot = slot
+
+    def _release(self):
+        if self._slot is not None:
+            self._slot.release()
+            self._slot = None
+
+    async def read(self, bot):
+        resp, self._resp = self._resp, None
+        if resp is None:
+            session = await get_session()
+            resp = await session.get(self.url)
+            if resp.status != 200:
+                resp.close()
+                resp.raise_for_status()
+        received = 0
+        try:
+            async with contextlib.aclosing(iter_download(self.url, resp, self.chunk_size)) as chunks:
+                async for chunk in chunks:
+                    received += len(chunk)
+                    if received > self.limit:
+                        raise FileTooLarge(received)
+                    yield chunk
+        finally:
+            self._release()
+
+    def close(self):
+        # если файл так и не ушел в телеграм, соединение с cdn надо отпустить самим
+        if self._resp is not None:
+            self._resp.close()
+            self._resp = None
+        self._release()
+
+
+async def open_attachment(url, filename):
+    """Открывает скачивание и смотрит только на заголовки: тело ещё не прочитано.
+
+    Возвращает StreamingInputFile или None, если CDN ответил не 200.
+    Если Content-Length больше LARGE_FILE_MAX_MB, кидает FileTooLarge, ничего не скачав.
+    Не дождались соединения (пул занят, CDN не отвечает) - DeliveryFailed, сообщение повторится.
+    """
+    session = await get_session()
+    try:
+        resp = await session.get(url)
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        raise DeliveryFailed(f"не удалось начать скачивание {filename}: {e!r}") from e
+    if resp.status != 200:
+        resp.close()
+        log.warning(f"Не удалось скачать вложение {filename}: статус {resp.status}")
+        return None
+    size = resp.content_length
+    if size is not None and size > LARGE_FILE_MAX_MB * 1024 * 1024:
+        resp.close()
+        raise FileTooLarge(size)
+    return StreamingInputFile(url, filename, resp=resp)
+
+
+async def resolve_attachment_url(client, a, chat_id, message_id):
+    atype = a.get("_type")
+    file_id = a.get("fileId") or a.get("videoId") or a.get("audioId")
+
+    target_url = a.get("baseUrl") or a.get("url")
+    if target_url:
+        return target_url
+    if atype in ["VIDEO", "VIDEO_MSG"] and file_id:
+        return await get_video_url(client, file_id, chat_id, message_id)
+    if file_id:
+        return await get_file_url(client, file_id, chat_id, message_id)
+    log.debug(f"Не найден URL или ID для вложения: {atype}")
+    return None
+
+
+class BlobInputFile(FSInputFile):
+    """Вложение, уже скачанное в MEDIA_BLOB_DIR: повторы отправки читают его с диска, а не с CDN."""
+
+    def __init__(self, path, filename, url, digest):
+        super().__init__(path, filename=filename, chunk_size=STREAM_CHUNK_SIZE)
+        self.url = url
+        self.digest = digest
+        self.size = os.path.getsize(path)
+
+    def close(self):
+        # файл остаётся в кэше, его уберёт вытеснение
+        pass
+
+
+class MediaCache:
+    """Telegram file_id уже отправленных вложений Max.
+
+    Ключ - id вложения в Max (photoId/videoId/fileId/audioId), а если включён MEDIA_BLOB_DIR,
+    то ещё и sha256 содержимого: тогда одинаковый файл под разными id тоже не грузится повторно.
+    Сами файлы в MEDIA_BLOB_DIR лежат под своим sha256, самые старые вытесняются по MEDIA_BLOB_MAX_MB.
+    """
+
+    def __init__(self, blob_dir=MEDIA_BLOB_DIR, blob_max_bytes=MEDIA_BLOB_MAX_MB * 1024 * 1024):
+        self.blob_dir = blob_dir
+        self.blob_max_bytes = blob_max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.hash_hits = 0
+        self.blob_hits = 0
+        self._blob_bytes = 0
+        self._evicting = False
+        if blob_dir:
+            os.makedirs(blob_dir, exist_ok=True)
+            self._blob_bytes = sum(e.stat().st_size for e in os.scandir(blob_dir) if e.is_file())
+
+    @staticmethod
+    def key(a):
+        for field in ("photoId", "videoId", "fileId", "audioId"):
+            if a.get(field) is not None:
+                return f"{field}:{a[field]}"
+        return None
+
+    def get(self, kind, key):
+        file_id = _cache.get("tg_file", f"{kind}:{key}") if key else None
+        if file_id:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return file_id
+
+    def get_by_digest(self, kind, digest):
+        file_id = _cache.get("tg_file", f"{kind}:sha:{digest}")
+        if file_id:
+            self.hash_hits += 1
+        return file_id
+
+    def remember(self, kind, key, message, digest=None):
+        file_id = sent_file_id(message)
+        if not file_id:
+            return
+        if key:
+            _cache.set("tg_file", f"{kind}:{key}", file_id)
+        if digest:
+            _cache.set("tg_file", f"{kind}:sha:{digest}", file_id)
+
+    def forget(self, kind, key, digest=None):
+        if key:
+            _cache.delete("tg_file", f"{kind}:{key}")
+        if digest:
+            _cache.delete("tg_file", f"{kind}:sha:{digest}")
+
+    def blob(self, key, filename, url):
+        """Уже скачанный файл этого вложения, если он ещё лежит на диске."""
+        digest = _cache.get("blob", key) if self.blob_dir and key else None
+        if not digest:
+            return None
+        path = os.path.join(self.blob_dir, digest)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        self.blob_hits += 1
+        return BlobInputFile(path, filename, url, digest)
+
+    async def spool(self, input_file, key):
+        """Докачивает вложение в MEDIA_BLOB_DIR, попутно считая sha256. Память - один кусок, запись - в потоках aiofiles."""
+        tmp = os.path.join(self.blob_dir, f".{os.getpid()}.{id(input_file)}.part")
+        digest = hashlib.sha256()
+        try:
+            async with aiofiles.open(tmp, "wb") as f:
+                async for chunk in input_file.read(bot):
+                    digest.update(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        digest = digest.hexdigest()
+        path = os.path.join(self.blob_dir, digest)
+        if os.path.exists(path):
+            os.remove(tmp)
+        else:
+            os.replace(tmp, path)
+            self._blob_bytes += os.path.getsize(path)
+            if self._blob_bytes > self.blob_max_bytes and not self._evicting:
+                # обход папки и удаление - в потоке; второй раз параллельно не запускаем
+                self._evicting = True
+                try:
+                    self._blob_bytes -= await asyncio.to_thread(self._evict, self._blob_bytes - self.blob_max_bytes)
+                finally:
+                    self._evicting = False
+        if key:
+            _cache.set("blob", key, digest)
+        return BlobInputFile(path, input_file.filename, input_file.url, digest)
+
+    def _evict(self, excess):
+        """Удаляет самые старые файлы, пока не освободит excess байт. Возвращает, сколько освободил."""
+        entries = sorted(
+            (e for e in os.scandir(self.blob_dir) if e.is_file() and not e.name.startswith(".")),
+            key=lambda e: e.stat().st_mtime
+        )
+        freed = 0
+        for entry in entries:
+            if freed >= excess:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            freed += size
+        return freed
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hash_hits": self.hash_hits,
+            "blob_hits": self.blob_hits,
+            "blob_bytes": self._blob_bytes,
+        }
+
+    def report(self):
+        s = self.stats()
+        return (
+            f"Медиакэш: попаданий {s['hits']}, промахов {s['misses']}, совпадений по содержимому {s['hash_hits']}, "
+            f"взято с диска {s['blob_hits']} ({s['blob_bytes'] // 1024 // 1024}MB на диске)"
+        )
+
+
+_media_cache = MediaCache()
+
+
+def sent_file_id(message):
+    if message is None:
+        return None
+    if message.photo:
+        return message.photo[-1].file_id
+    for attr in ("video", "video_note", "voice", "audio", "animation", "document"):
+        obj = getattr(message, attr, None)
+        if obj is not None:
+            return obj.file_id
+    return None
+
+
+def attachment_kind(a):
+    """Каким методом Bot API отправлять вложение."""
+    atype = a.get("_type")
+    if atype == "PHOTO":
+        return "photo"
+    if atype == "VOICE":
+        return "voice"
+    if atype == "AUDIO":
+        return "voice" if a.get("wave") else "audio"
+    if atype == "VIDEO_MSG" or (atype == "VIDEO" and a.get("videoType") == 1 and a.get("width") == a.get("height")):
+        return "video_note"
+    if atype == "VIDEO":
+        return "video"
+    return "document"
+
+
+async def send_large(kind, spooled, file_name, kb, targets, sent=None, part=None):
+    """Отправляет SpooledFile целиком, если лимит позволяет, иначе документом по частям.
+
+    Возвращает сообщение для кэша file_id или None, если ушло частями.
+    """
+    if spooled.size <= TELEGRAM_UPLOAD_LIMIT:
+        return await send_media_all(kind, spooled.input_file(), file_name, kb, targets, sent=sent, part=part)
+    for number, count, chunk in spooled.parts():
+        await send_media_all("document", chunk, file_name, kb, targets, caption=f"📎 {file_name} (часть {number}/{count})",
+                             sent=sent, part=f"{part}.{number}")
+    return None
+
+
+def part_key(part, target):
+    return f"{part}@{target.chat_id}:{target.thread_id}"
+
+
+def unsent(sent, part, targets):
+    """Цели, в которые эта часть сообщения ещё не ушла."""
+    if sent is None:
+        return list(targets)
+    return [target for target in targets if part_key(part, target) not in sent]
+
+
+async def send_once(sent, part, target, send):
+    """Отправляет часть сообщения в target, если её туда ещё не отправляли.
+
+    sent - список уже отправленного, он лежит в самом сообщении: после DeliveryFailed воркер повторяет
+    сообщение целиком, и то, что уже ушло, второй раз не уходит. Без sent просто отправляет.
+    """
+    if sent is None:
+        return await send()
+    key = part_key(part, target)
+    if key in sent:
+        return None
+    result = await send()
+    sent.append(key)
+    return result
+
+
+async def send_media_all(kind, media, file_name, kb, targets, caption=None, sent=None, part=None):
+    """Выгружает media в первую цель, остальным параллельно шлёт полученный file_id.
+
+    Сколько бы ни было целей, файл качается и грузится в телеграм один раз. Возвращает сообщение первой цели
+    (None, если во все цели эта часть уже ушла при прошлой попытке).
+    """
+    targets = unsent(sent, part, targets)
+    if not targets:
+        return None
+    first = targets[0]
+    message = await send_once(sent, part, first, lambda: send_media(kind, media, file_name, kb, first, caption))
+    if len(targets) > 1:
+        media = sent_file_id(message) or media
+        await deliver_all(
+            send_once(sent, part, target, lambda target=target: send_media(kind, media, file_name, kb, target, caption))
+            for target in targets[1:]
+        )
+    return message
+
+
+async def send_media(kind, media, file_name, kb, target, caption=None):
+    if isinstance(media, str):
+        # file_id или путь на своём Bot API сервере - выгружать нечего
+        return await _send_media(kind, media, file_name, kb, target, caption, None)
+    async with transfer_slots(getattr(media, "size", None), _upload_slots, _large_upload_slots):
+        return await _send_media(kind, media, file_name, kb, target, caption, TELEGRAM_UPLOAD_TIMEOUT)
+
+
+async def _send_media(kind, media, file_name, kb, target, caption, timeout):
+    if kind == "photo":
+        return await bot.send_photo(target.chat_id, photo=media, caption=caption or "📷 Фото", reply_markup=kb, message_thread_id=target.thread_id, request_timeout=timeout)
+    if kind == "voice":
+        return await bot.send_voice(target.chat_id, voice=media, reply_markup=kb, message_thread_id=target.thread_id, request_timeout=timeout)
+    if kind == "audio":
+        return await bot.send_audio(target.chat_id, audio=media, caption=caption or f"🎵 {file_name}", reply_markup=kb, message_thread_id=target.thread_id, request_timeout=timeout)
+    if kind == "video_note":
+        return await bot.send_video_note(target.chat_id, video_note=media, reply_markup=kb, message_thread_id=target.thread_id, request_timeout=timeout)
+    if kind == "video":
+        return await bot.send_video(target.chat_id, video=media, caption=caption or f"📹 {file_name}", reply_markup=kb, message_thread_id=target.thread_id, request_timeout=timeout)
+    return await bot.send_document(target.chat_id, document=media, caption=caption or f"📎 {file_name}", reply_markup=kb, message_thread_id=target.thread_id, request_timeout=timeout)
+
+
+async def send_album(media_list, kb, target):
+    if all(isinstance(item.media, str) for item in media_list):
+        messages = await bot.send_media_group(target.chat_id, media=media_list, message_thread_id=target.thread_id)
+    else:
+        async with _upload_slots:
+            messages = await bot.send_media_group(
+                target.chat_id, media=media_list, message_thread_id=target.thread_id,
+                request_timeout=TELEGRAM_UPLOAD_TIMEOUT
+            )
+    await bot.send_message(
+        target.chat_id, 
+        text="Фото/Видео", 
+        reply_markup=kb, 
+        message_thread_id=target.thread_id
+    )
+    return messages
+
+
+def forget_attachment_url(a):
+    """Убирает из кэша ссылку на вложение. True, если там что-то было."""
+    if a.get("baseUrl") or a.get("url"):
+        return False
+    file_id = a.get("fileId") or a.get("videoId") or a.get("audioId")
+    kind = "video" if a.get("_type") in ["VIDEO", "VIDEO_MSG"] else "file"
+    if file_id is None or _cache.get(kind, file_id) is None:
+        return False
+    _cache.delete(kind, file_id)
+    return True
+
+
+async def prepare_attachment(client, a, filename, chat_id, message_id, message_slots, max_size=None, hold_slot=True):
+    """Резолвит ссылку и открывает скачивание под лимитами сообщения и всего бота.
+
+    С MEDIA_BLOB_DIR файл докачивается на диск целиком (или берётся оттуда, если уже есть),
+    файл больше 50МБ - тоже, во временный SpooledFile. Остальные качаются уже во время выгрузки в телеграм
+    и держат место в _download_slots, пока тело не дочитано (hold_slot=False - не держат: элементы альбома
+    читаются все разом сразу после открытия, а держа места, два больших альбома могли бы ждать друг друга).
+    Если по Content-Length файл больше max_size, он не качается: кидаем TooLargeForAlbum.
+    """
+    key = MediaCache.key(a)
+    if _media_cache.blob_dir:
+        blob = _media_cache.blob(key, filename, a.get("baseUrl") or a.get("url"))
+        if blob is not None:
+            return blob
+
+    async with message_slots:
+        await _download_slots.acquire()
+        try:
+            target_url = await resolve_attachment_url(client, a, chat_id, message_id)
+            input_file = await open_attachment(target_url, filename) if target_url else None
+            if input_file is None and target_url and forget_attachment_url(a):
+                # ссылка из кэша могла протухнуть раньше TTL, спрашиваем свежую
+                target_url = await resolve_attachment_url(client, a, chat_id, message_id)
+                if target_url:
+                    input_file = await open_attachment(target_url, filename)
+        except BaseException:
+            _download_slots.release()
+            raise
+    if input_file is None:
+        _download_slots.release()
+        return None
+    if max_size is not None and (input_file.size or 0) > max_size:
+        _download_slots.release()
+        input_file.close()
+        raise TooLargeForAlbum(input_file.size)
+
+    # размер уже известен по заголовкам: тело большого файла качаем в его отдельной очереди.
+    # Без Content-Length размер узнаем, только скачав, - тоже на диск: посреди выгрузки FileTooLarge
+    # до нас не дойдёт (aiohttp и aiogram завернут его в сетевую ошибку), и файл будут перекачивать на каждом повторе
+    spool = input_file.size is None and not _media_cache.blob_dir or (input_file.size or 0) > STANDARD_UPLOAD_LIMIT
+    if not spool and not _media_cache.blob_dir:
+        # качается во время выгрузки: открытый ответ держит соединение с CDN, так что и место - до конца чтения
+        if hold_slot:
+            input_file.hold(_download_slots)
+        else:
+            _download_slots.release()
+        return input_file
+    _download_slots.release()
+    async with transfer_slots(input_file.size, _download_slots, _large_download_slots):
+        if spool:
+            return await spool_large(input_file)
+        return await _media_cache.spool(input_file, key)
 
 
-async def send_attachments(websocket, attaches, chat_id, message_id, sender_name=None, chat_name=None):
+async def send_attachments(client, attaches, chat_id, message_id, sender_name=None, chat_name=None, targets=(DEFAULT_TARGET,),
+                           sent=None):
+    """Отправляет вложения во все targets. sent - что уже ушло при прошлых попытках (см. send_once)."""
     if not attaches:
         return
 
     kb = build_keyboard(sender_name, chat_name)
+    message_slots = asyncio.Semaphore(MESSAGE_DOWNLOAD_CONCURRENCY)
     
     album_candidates = [a for a in attaches if a.get("_type") in ["PHOTO", "VIDEO"]]
     remaining_attaches = [a for a in attaches if a not in album_candidates]
+    positions = {id(a): i for i, a in enumerate(attaches)}
+    moved = {}  # {id(a): SpooledFile или None} - элементы альбома больше лимита, уходят после него по одному
 
+    album_targets = unsent(sent, "album", targets)
     if album_candidates:
-        if len(album_candidates) > 1:
-            media_list = []
-            for a in album_candidates[:10]:
-                atype = a.get("_type")
-                file_id = a.get("fileId") or a.get("videoId")
-                
-                target_url = a.get("baseUrl") or a.get("url")
-                if not target_url and atype == "VIDEO" and file_id:
-                    target_url = await get_video_url(websocket, file_id, chat_id, message_id)
-                elif not target_url and file_id:
-                    target_url = await get_file_url(websocket, file_id, chat_id, message_id)
-                
-                if target_url:
-                    try:
-                        session = await get_session()
-                        async with session.get(target_url) as resp:
-                            if resp.status == 200:
-                                content = await resp.read()
-                                if len(content) <= 50 * 1024 * 1024:
-                                    ext = ".jpg" if atype == "PHOTO" else ".mp4"
-                                    fname = a.get("name") or (f"media{ext}")
-                                    input_file = BufferedInputFile(content, filename=fname)
-                                    
-                                    if atype == "PHOTO":
-                                        media_list.append(InputMediaPhoto(media=input_file))
-                                    else:
-                                        media_list.append(InputMediaVideo(media=input_file))
-                    except Exception as e:
-                        print(f"Ошибка при скачивании медиа для альбома: {e}")
+        if len(album_candidates) > 1 and not album_targets:
+            # альбом ушёл во все чаты при прошлой попытке, а отложенные из него элементы - ещё, может, и нет
+            moved = {id(a): None for a in album_candidates[:10] if f"moved:file{positions[id(a)]}" in sent}
+        elif len(album_candidates) > 1:
+            album = album_candidates[:10]
+            names = []
+            cached = []
+            for a in album:
+                ext = ".jpg" if a.get("_type") == "PHOTO" else ".mp4"
+                names.append(a.get("name") or (f"media{ext}"))
+                kind = "photo" if a.get("_type") == "PHOTO" else "video"
+                cached.append(_media_cache.get(kind, MediaCache.key(a)))
+
+            # все элементы альбома резолвим и открываем разом, gather сохраняет исходный порядок;
+            # то, что уже есть в телеграме, не качаем вовсе, а то, что больше лимита, - не качаем для альбома
+            results = await asyncio.gather(
+                *(prepare_attachment(client, a, fname, chat_id, message_id, message_slots,
+                                   max_size=TELEGRAM_UPLOAD_LIMIT, hold_slot=False)
+                  if file_id is None else _done(file_id)
+                  for a, fname, file_id in zip(album, names, cached)),
+                return_exceptions=True
+            )
+            failed = next((r for r in results if isinstance(r, DeliveryFailed)), None)
+            if failed is not None:
+                for r in results:
+                    if r is not None and not isinstance(r, (BaseException, str)):
+                        r.close()
+                raise failed
+
+            files = []
+
+            def build(results):
+                media_list = []
+                sent_items = []  # (kind, ключ, sha256 или None, взят ли из кэша, имя, номер в альбоме)
+                for i, (a, fname, media) in enumerate(zip(album, names, results)):
+                    if isinstance(media, (TooLargeForAlbum, FileTooLarge)):
+                        # уйдёт отдельно: частями или с предупреждением, что слишком велик
+                        moved[id(a)] = None
+                        continue
+                    if isinstance(media, BaseException):
+                        log.warning(f"Ошибка при скачивании медиа для альбома: {media}")
+                        continue
+                    if media is None:
+                        continue
+
+                    kind = "photo" if a.get("_type") == "PHOTO" else "video"
+                    digest = None
+                    if isinstance(media, SpooledFile):
+                        if media.size > TELEGRAM_UPLOAD_LIMIT:
+                            # размер узнали, только скачав: файл уже на диске, отдаём его send_large
+                            moved[id(a)] = media
+                            continue
+                        files.append(media)
+                        sent_items.append((kind, MediaCache.key(a), None, False, fname, i))
+                        media = media.input_file()
+                    else:
+                        if not isinstance(media, str):
+                            files.append(media)
+                            digest = getattr(media, "digest", None)
+                            file_id = _media_cache.get_by_digest(kind, digest) if digest else None
+                            if file_id:
+                                media = file_id
+                        sent_items.append((kind, MediaCache.key(a), digest, isinstance(media, str), fname, i))
+                    if kind == "photo":
+                        media_list.append(InputMediaPhoto(media=media))
+                    else:
+                        media_list.append(InputMediaVideo(media=media))
+                if sent is not None:
+                    # чтобы при повторе, когда альбом уже ушёл, знать, что эти элементы ещё надо отправить
+                    sent.extend(marker for marker in (f"moved:file{positions[id(a)]}" for a in album if id(a) in moved)
+                                if marker not in sent)
+                return media_list, sent_items
+
+            async def send_built(media_list, sent_items):
+                if len(media_list) == 1:
+                    # альбом из одного элемента телеграм не принимает
+                    kind, key, digest, _, fname, _ = sent_items[0]
+                    message = await send_media_all(kind, media_list[0].media, fname, kb, album_targets, sent=sent, part="album")
+                    _media_cache.remember(kind, key, message, digest)
+                elif media_list:
+                    first = album_targets[0]
+                    messages = await send_once(sent, "album", first, lambda: send_album(media_list, kb, first))
+                    for (kind, key, digest, *_), message in zip(sent_items, messages):
+                        _media_cache.remember(kind, key, message, digest)
+                    if len(album_targets) > 1:
+                        # в остальные чаты - уже загруженными file_id, параллельно
+                        media_list = [type(item)(media=sent_file_id(message) or item.media)
+                                      for item, message in zip(media_list, messages)]
+                        await deliver_all(
+                            send_once(sent, "album", target, lambda target=target: send_album(media_list, kb, target))
+                            for target in album_targets[1:]
+                        )
 
-            if media_list:
+            try:
+                media_list, sent_items = build(results)
                 try:
-                    await bot.send_media_group(TELEGRAM_CHAT_ID, media=media_list, message_thread_id=TELEGRAM_THREAD_ID)
-                    await bot.send_message(
-                        TELEGRAM_CHAT_ID, 
-                        text="Фото/Видео", 
-                        reply_markup=kb, 
-                        message_thread_id=TELEGRAM_THREAD_ID
-                    )
+                    await send_built(media_list, sent_items)
+                except (DeliveryFailed, asyncio.CancelledError):
+                    raise
                 except Exception as e:
-                    print(f"Ошибка при отправке альбома: {e}")
+                    # возможно, телеграм не принял старый file_id: забываем их и один раз загружаем эти элементы заново
+                    stale = [item for item in sent_items if item[3]]
+                    for kind, key, digest, *_ in stale:
+                        _media_cache.forget(kind, key, digest)
+                    if not stale:
+                        raise
+                    log.warning(f"Телеграм не принял сохранённые file_id в альбоме, загружаем заново: {e}")
+                    fresh = await asyncio.gather(
+                        *(prepare_attachment(client, album[i], fname, chat_id, message_id, message_slots,
+                                             max_size=TELEGRAM_UPLOAD_LIMIT, hold_slot=False)
+                          for *_, fname, i in stale),
+                        return_exceptions=True
+                    )
+                    results = list(results)
+                    for (*_, i), media in zip(stale, fresh):
+                        results[i] = media
+                    failed = next((r for r in fresh if isinstance(r, DeliveryFailed)), None)
+                    if failed is not None:
+                        files.extend(r for r in fresh if r is not None and not isinstance(r, (BaseException, str)))
+                        raise failed
+                    await send_built(*build(results))
+            except (DeliveryFailed, asyncio.CancelledError):
+                for f in moved.values():
+                    if f is not None:
+                        f.close()
+                raise
+            except Exception as e:
+                log.warning(f"Ошибка при отправке альбома: {e}")
+            finally:
+                for f in files:
+                    f.close()
         else:
             remaining_attaches.insert(0, album_candidates[0])
+    remaining_attaches[:0] = [a for a in album_candidates if id(a) in moved]
 
+    queue = []
     for a in remaining_attaches:
-        print(f"DEBUG: Аттач пришел: {json.dumps(a)}")
-        
-        atype = a.get("_type")
-        file_id = a.get("fileId") or a.get("videoId") or a.get("audioId")
+        log.debug("Аттач пришел: %s", a)
+        part = f"file{positions[id(a)]}"
+        spooled = moved.pop(id(a), None)
+        if not unsent(sent, part, targets):
+            # ушло во все чаты при прошлой попытке
+            if spooled is not None:
+                spooled.close()
+            continue
 
+        atype = a.get("_type")
         file_name = a.get("name")
         if not file_name:
             if atype == "VIDEO": file_name = "Видео"
             elif atype == "PHOTO": file_name = "Фото"
             elif atype == "AUDIO": file_name = "Аудио"
             else: file_name = "Файл"
-            
-        base_url = a.get("baseUrl")
-        direct_url = a.get("url")
-        
-        if base_url:
-            target_url = base_url
-        elif direct_url:
-            target_url = direct_url
-        elif atype in ["VIDEO", "VIDEO_MSG"] and file_id:
-            target_url = await get_video_url(websocket, file_id, chat_id, message_id)
-        elif file_id:
-            target_url = await get_file_url(websocket, file_id, chat_id, message_id)
-        else:
-            print(f"DEBUG: Не найден URL или ID для вложения: {atype}")
-            continue
 
-        if target_url:
+        kind = attachment_kind(a)
+        key = MediaCache.key(a)
+        file_id = _media_cache.get(kind, key)
+        if file_id is None and kind == "video_note":
+            # кружок, который в прошлый раз ушёл обычным видео
+            file_id = _media_cache.get("video", key)
+            if file_id is not None:
+                kind = "video"
+
+        task = None
+        if file_id is not None:
+            if spooled is not None:
+                spooled.close()
+        elif spooled is not None:
+            # уже скачан для альбома, но туда не влез
+            task = asyncio.create_task(_done(spooled))
+        queue.append((a, part, file_name, kind, key, file_id, task))
+    tasks = [task for *_, task in queue]
+
+    def prefetch(start):
+        # ссылки резолвим и открываем заранее, пока предыдущие вложения уходят в телеграм, но не больше
+        # MESSAGE_DOWNLOAD_CONCURRENCY вперёд: открытый ответ держит соединение с CDN до своей очереди на выгрузку
+        for i in range(start, min(start + MESSAGE_DOWNLOAD_CONCURRENCY, len(queue))):
+            a, _, file_name, _, _, file_id, _ = queue[i]
+            if tasks[i] is None and file_id is None:
+                tasks[i] = asyncio.create_task(
+                    prepare_attachment(client, a, file_name, chat_id, message_id, message_slots)
+                )
+
+    try:
+        for i, (a, part, file_name, kind, key, file_id, _) in enumerate(queue):
+            prefetch(i)
+            task = tasks[i]
+            atype = a.get("_type")
+            input_file = None
             try:
-                session = await get_session()
-                async with session.get(target_url) as resp:
-                    if resp.status == 200:
-                        content = await resp.read()
-                        file_size = len(content)
-                        
-                        if file_size > 50 * 1024 * 1024: # лимит тг - 50МБ
-                            await send_to_telegram(
-                                f"⚠️ Файл <b>{file_name}</b> слишком велик для пересылки (>{file_size//1024//1024}MB).",
-                                sender_name=sender_name,
-                                chat_name=chat_name
-                            )
-                            continue
+                if file_id is not None:
+                    try:
+                        await send_media_all(kind, file_id, file_name, kb, targets, sent=sent, part=part)
+                        continue
+                    except DeliveryFailed:
+                        raise
+                    except Exception as e:
+                        log.warning(f"Телеграм не принял сохранённый file_id для {file_name}, загружаем заново: {e}")
+                        _media_cache.forget(kind, key)
+                        kind = attachment_kind(a)
+                        task = tasks[i] = asyncio.create_task(
+                            prepare_attachment(client, a, file_name, chat_id, message_id, message_slots)
+                        )
+
+                input_file = await task
+                if input_file is None:
+                    continue
+
+                if isinstance(input_file, SpooledFile):
+                    if kind == "video_note" and input_file.size > STANDARD_UPLOAD_LIMIT:
+                        # такой большой кружок уходит обычным видео, и в кэше его file_id - видео
+                        kind = "video"
+                    message = await send_large(kind, input_file, file_name, kb, targets, sent=sent, part=part)
+                    _media_cache.remember(kind, key, message)
+                    continue
 
-                        input_file = BufferedInputFile(content, filename=file_name)
-                        
-                        if atype == "PHOTO":
-                            if not file_name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-                                input_file.filename = "photo.jpg"
-                            await bot.send_photo(TELEGRAM_CHAT_ID, photo=input_file, caption="📷 Фото", reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                        elif atype == "VOICE":
-                            await bot.send_voice(TELEGRAM_CHAT_ID, voice=input_file, reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                        elif atype == "AUDIO":
-                            if a.get("wave"):
-                                await bot.send_voice(TELEGRAM_CHAT_ID, voice=input_file, reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                            else:
-                                await bot.send_audio(TELEGRAM_CHAT_ID, audio=input_file, caption=f"🎵 {file_name}", reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                        elif atype == "VIDEO_MSG" or (atype == "VIDEO" and a.get("videoType") == 1 and a.get("width") == a.get("height")):
-                            try:
-                                if not input_file.filename.lower().endswith('.mp4'):
-                                    input_file.filename = "video_note.mp4"
-                                await bot.send_video_note(TELEGRAM_CHAT_ID, video_note=input_file, reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                            except Exception as ve:
-                                print(f"Не удалось отправить как кружок, пробуем как видео: {ve}")
-                                input_file = BufferedInputFile(content, filename="video.mp4")
-                                await bot.send_video(TELEGRAM_CHAT_ID, video=input_file, caption="📹 Кружок", reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                        elif atype == "VIDEO":
-                            await bot.send_video(TELEGRAM_CHAT_ID, video=input_file, caption=f"📹 {file_name}", reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
+                digest = getattr(input_file, "digest", None)
+                file_id = _media_cache.get_by_digest(kind, digest) if digest else None
+                if file_id is not None:
+                    # тот же файл уже загружали под другим id
+                    message = await send_media_all(kind, file_id, file_name, kb, targets, sent=sent, part=part)
+                    _media_cache.remember(kind, key, message)
+                    continue
+
+                if kind == "photo" and not file_name.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
+                    input_file.filename = "photo.jpg"
+                if kind == "video_note":
+                    try:
+                        if not input_file.filename.lower().endswith('.mp4'):
+                            input_file.filename = "video_note.mp4"
+                        message = await send_media_all(kind, input_file, file_name, kb, targets, sent=sent, part=part)
+                    except (FileTooLarge, DeliveryFailed):
+                        raise
+                    except Exception as ve:
+                        log.warning(f"Не удалось отправить как кружок, пробуем как видео: {ve}")
+                        input_file.close()
+                        kind = "video"
+                        if isinstance(input_file, BlobInputFile):
+                            input_file = BlobInputFile(input_file.path, "video.mp4", input_file.url, digest)
                         else:
-                            await bot.send_document(TELEGRAM_CHAT_ID, document=input_file, caption=f"📎 {file_name}", reply_markup=kb, message_thread_id=TELEGRAM_THREAD_ID)
-                    else:
-                        print(f"Не удалось скачать вложение {file_name}: статус {resp.status}")
+                            input_file = StreamingInputFile(input_file.url, "video.mp4")
+                        message = await send_media_all(kind, input_file, file_name, kb, targets, caption="📹 Кружок",
+                                                       sent=sent, part=part)
+                else:
+                    message = await send_media_all(kind, input_file, file_name, kb, targets, sent=sent, part=part)
+                _media_cache.remember(kind, key, message, digest)
+            except FileTooLarge as e:
+                notice = f"⚠️ Файл <b>{html.escape(file_name, quote=False)}</b> слишком велик для пересылки (>{e.size//1024//1024}MB)."
+                await deliver_all(send_once(sent, part, target, lambda target=target: send_to_telegram(
+                    notice,
+                    sender_name=sender_name,
+                    chat_name=chat_name,
+                    escape=False,
+                    target=target
+                )) for target in targets)
+            except DeliveryFailed:
+                raise
             except Exception as e:
-                print(f"Ошибка при обработке вложения {file_name} ({atype}): {e}")
+                log.warning(f"Ошибка при обработке вложения {file_name} ({atype}): {e}")
+            finally:
+                if input_file is not None:
+                    input_file.close()
+    finally:
+        # если нас отменили на середине, уже открытые скачивания надо закрыть
+        for task in tasks:
+            if task is None:
+                continue
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None and task.result() is not None:
+                task.result().close()
 
 
-async def get_user_name(websocket, sender_id):
-    sender_id = str(sender_id)
-    if sender_id in _name_cache:
-        return _name_cache[sender_id]
+async def _done(value):
+    return value
 
-    seq = next_seq()
-    s_seq = str(seq)
-    future = asyncio.get_running_loop().create_future()
-    _dispatcher[s_seq] = future
-    
-    request = {
-        "ver": 11,
-        "cmd": 0,
-        "seq": seq,
-        "opcode": 32,
-        "payload": {"contactIds": [int(sender_id)]}
-    }
+
+def contact_name(contact, default):
+    names = contact.get("names") or [{}]
+    return names[0].get("name") or default
+
+
+def remember_contacts(contacts):
+    for contact in contacts or []:
+        if contact.get("id") is not None:
+            cid = str(contact["id"])
+            _cache.set("name", cid, contact_name(contact, cid))
+
+
+class NameResolver:
+    """Копит неизвестные id в течение NAME_BATCH_WINDOW_MS и спрашивает их одним opcode 32.
+
+    На каждый id в полёте ровно одна future, параллельные запросы одного и того же id её делят.
+    """
+
+    def __init__(self, window=None, max_batch=None):
+        self.window = NAME_BATCH_WINDOW_MS / 1000 if window is None else window
+        self.max_batch = max_batch or NAME_BATCH_SIZE
+        self._pending = {}  # {id: future} ещё не отправлены
+        self._inflight = {}  # {id: future} ждут ответа
+        self._client = None
+        self._timer = None
+
+    async def get(self, client, sender_id):
+        sender_id = str(sender_id)
+        name = _cache.get("name", sender_id)
+        if name is not None:
+            return name
+        if not sender_id.lstrip("-").isdigit():
+            return sender_id
+
+        future = self._inflight.get(sender_id) or self._pending.get(sender_id)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[sender_id] = future
+            self._client = client
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        # shield: отмена одного ожидающего не должна ронять future остальным
+        return await asyncio.shield(future)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        self._inflight.update(batch)
+        asyncio.create_task(self._request(self._client, batch))
+
+    async def _request(self, client, batch):
+        try:
+            data = await client.request(32, {"contactIds": [int(cid) for cid in batch]})
+            if data.get("opcode") == 32:
+                remember_contacts(data.get("payload", {}).get("contacts"))
+        except Exception as e:
+            log.warning(f"Ошибка при запросе имён ({', '.join(batch)}): {e}")
+        finally:
+            for cid, waiter in batch.items():
+                self._inflight.pop(cid, None)
+                if not waiter.done():
+                    waiter.set_result(_cache.get("name", cid) or cid)
+
+
+async def get_user_name(client, sender_id):
+    return await client.account.names.get(client, sender_id)
+
+
+def forward_chain(message, limit=10):
+    """Пересланные сообщения внутри message: от внешней пересылки к самой глубокой."""
+    link = message.get("link") or {}
+    while limit and link.get("type") == "FORWARD" and link.get("message"):
+        message = link["message"]
+        yield message
+        link = message.get("link") or {}
+        limit -= 1
+
+
+def message_types(data):
+    """Типы сообщения для правил маршрутизации: text, forward и виды вложений (photo, video, document...)."""
+    message = data["payload"]["message"]
+    types = set()
+    for msg in (message, *forward_chain(message)):
+        if msg is not message:
+            types.add("forward")
+        if (msg.get("text") or "").strip():
+            types.add("text")
+        for a in msg.get("attaches") or []:
+            types.add(attachment_kind(a))
+    return types
+
+
+def message_text(data):
+    message = data["payload"]["message"]
+    return "\n".join(msg.get("text") or "" for msg in (message, *forward_chain(message)))
+
+
+class Rule:
+    """Одно правило маршрутизации. Пустое условие (None) подходит ко всему."""
+
+    __slots__ = ("accounts", "chats", "senders", "private", "types", "text", "targets", "stop")
+
+    def __init__(self, raw):
+        def ids(key):
+            value = raw.get(key)
+            if value is None:
+                return None
+            if not isinstance(value, list):
+                value = [value]
+            return {str(v).strip() for v in value}
+
+        self.accounts = ids("account")
+        self.chats = ids("chats")
+        self.senders = ids("senders")
+        self.private = raw.get("private")
+        self.types = ids("types")
+        self.text = re.compile(raw["text"]) if raw.get("text") else None
+        to = raw.get("to", [])
+        if not isinstance(to, list):
+            to = [to]
+        # None - основной чат аккаунта, подставляется при маршрутизации
+        self.targets = tuple(
+            None if t == "default" else
+            Target(str(t["chat_id"]), parse_thread_id(t.get("thread_id"))) if isinstance(t, dict) else
+            Target(str(t), None)
+            for t in to
+        )
+        self.stop = bool(raw.get("stop") or raw.get("drop"))
+        if not self.targets and not raw.get("drop"):
+            raise ValueError(f"у правила нет ни to, ни drop: {raw}")
+
+    def matches(self, account, private, sender, types, text):
+        if self.accounts is not None and account not in self.accounts:
+            return False
+        if self.private is not None and bool(self.private) != private:
+            return False
+        if self.senders is not None and sender not in self.senders:
+            return False
+        if self.types is not None and self.types.isdisjoint(types()):
+            return False
+        if self.text is not None and not self.text.search(text()):
+            return False
+        return True
+
+
+class Router:
+    """Маршруты из ROUTES_FILE: какие сообщения Max в какие чаты и темы телеграма.
+
+    Правила проверяются по порядку, цели всех подошедших правил складываются, правило со stop
+    (или drop) прекращает проверку. Правила с chats разложены по id чата, с senders - по id отправителя,
+    так что на сообщение проверяются только свои правила и правила без этих условий.
+    Если не подошло ни одно правило, сообщение идёт в основной чат аккаунта (или никуда при "default": false).
+
+    Файл перечитывается при изменении, новая таблица подменяет старую целиком - соединения не трогаем.
+    """
+
+    def __init__(self, path=ROUTES_FILE):
+        self.path = path
+        self.mtime = None
+        # (правила, индекс по чату, индекс по отправителю, прочие, слать ли в основной чат)
+        self._table = ((), {}, {}, (), True)
+        if path:
+            self.reload()
+
+    @staticmethod
+    def compile(config):
+        if isinstance(config, list):
+            config = {"rules": config}
+        rules = tuple(Rule(raw) for raw in config.get("rules", []))
+        by_chat = {}
+        by_sender = {}
+        rest = []
+        for i, rule in enumerate(rules):
+            if rule.chats is not None:
+                for chat_id in rule.chats:
+                    by_chat.setdefault(chat_id, []).append(i)
+            elif rule.senders is not None:
+                for sender in rule.senders:
+                    by_sender.setdefault(sender, []).append(i)
+            else:
+                rest.append(i)
+        return rules, by_chat, by_sender, tuple(rest), bool(config.get("default", True))
+
+    def reload(self):
+        mtime = os.path.getmtime(self.path)
+        with open(self.path, encoding="utf-8") as f:
+            table = self.compile(json.load(f))
+        self._table = table
+        self.mtime = mtime
+        log.info(f"Маршруты загружены из {self.path}: {len(table[0])} правил")
+
+    def maybe_reload(self):
+        try:
+            if os.path.getmtime(self.path) != self.mtime:
+                self.reload()
+        except Exception as e:
+            # битый файл не должен ронять пересылку - работаем по старым правилам
+            log.warning(f"Не удалось перечитать маршруты {self.path}, остаются прежние: {e}")
+
+    async def watch(self, interval=ROUTES_RELOAD_INTERVAL):
+        while True:
+            await asyncio.sleep(interval)
+            self.maybe_reload()
+
+    def route(self, account, data):
+        """Куда переслать сообщение: список Target без повторов, пустой - никуда."""
+        rules, by_chat, by_sender, rest, default = self._table
+        payload = data["payload"]
+        private = data.get("opcode") == 64
+        if not private and account.allowed_chat_ids and str(payload.get("chatId")) not in account.allowed_chat_ids:
+            return []
+        if not rules:
+            return [account.target]
+
+        sender = str(payload["message"].get("sender"))
+        chat_id = str(payload.get("chatId", sender))
+        types = functools.cache(lambda: message_types(data))
+        text = functools.cache(lambda: message_text(data))
+        targets = []
+        matched = False
+        for i in heapq.merge(by_chat.get(chat_id, ()), by_sender.get(sender, ()), rest):
+            rule = rules[i]
+            if not rule.matches(account.name, private, sender, types, text):
+                continue
+            matched = True
+            for target in rule.targets:
+                target = target or account.target
+                if target not in targets:
+                    targets.append(target)
+            if rule.stop:
+                break
+        if not matched and default:
+            return [account.target]
+        return targets
+
+
+_router = Router()
+
+
+class NormalizedMessage:
+    """Личное или групповое сообщение Max, разобранное за один проход.
+
+    Имена уже известны, тексты как есть (экранирует render). forwards - [(имя, текст)] от внешней
+    пересылки к самой глубокой, reply - (имя, текст, есть ли вложения) или None, attaches - вложения
+    самого сообщения и всех пересланных, в порядке появления.
+    """
+
+    __slots__ = ("opcode", "chat_id", "message_id", "sender_name", "chat_name", "text", "forwards", "reply", "attaches")
+
+    REPLY_PREVIEW = 200
+
+    def __init__(self, opcode, chat_id, message_id, sender_name, chat_name, text, forwards, reply, attaches):
+        self.opcode = opcode
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.sender_name = sender_name
+        self.chat_name = chat_name
+        self.text = text
+        self.forwards = forwards
+        self.reply = reply
+        self.attaches = attaches
+
+    def render(self):
+        """HTML для телеграма; пустая строка, если текста нет ни у сообщения, ни у пересылок."""
+        text = ""
+        if self.reply is not None:
+            name, quote, has_attaches = self.reply
+            quote = quote.strip()
+            if len(quote) > self.REPLY_PREVIEW:
+                quote = quote[:self.REPLY_PREVIEW] + "…"
+            quote = html.escape(quote, quote=False) if quote else ("<i>вложение</i>" if has_attaches else "")
+            text = f"<blockquote>↪️ <b>{html.escape(name, quote=False)}</b>: {quote}</blockquote>\n"
+        if self.text:
+            text += html.escape(self.text, quote=False)
+        for name, fwd_text in self.forwards:
+            text += f"\n\n↩️ <b>Переслано от {html.escape(name, quote=False)}:</b>\n{html.escape(fwd_text, quote=False)}"
+        return text
+
+
+async def normalize_message(client, data, groups):
+    payload = data["payload"]
+    message = payload["message"]
+    opcode = data.get("opcode")
+    sender = str(message["sender"])
+    # у личных вложения запрашиваются по id собеседника
+    chat_id = sender if opcode == 64 else str(payload["chatId"])
+    forwarded = list(forward_chain(message))
+    link = message.get("link") or {}
+    replied = link.get("message") if link.get("type") == "REPLY" else None
+
+    # все имена разом: NameResolver сложит неизвестные в один opcode 32
+    senders = [sender, *(str(m.get("sender")) for m in forwarded)]
+    if replied:
+        senders.append(str(replied.get("sender")))
+    names = await asyncio.gather(*(get_user_name(client, s) for s in senders))
+
+    attaches = list(message.get("attaches") or [])
+    for m in forwarded:
+        attaches.extend(m.get("attaches") or [])
+    reply = None
+    if replied:
+        reply = (names[-1], replied.get("text") or "", bool(replied.get("attaches")))
+    chat_name = None
+    if opcode == 128:
+        chat_name = groups.get(chat_id) or _cache.get("chat", chat_id) or chat_id
+    return NormalizedMessage(
+        opcode, chat_id, message["id"], names[0], chat_name, message.get("text") or "",
+        [(name, m.get("text") or "") for name, m in zip(names[1:], forwarded)], reply, attaches
+    )
+
+
+async def forward_message(client, message, targets, sent=None):
+    text = message.render()
+    if text or not message.attaches:
+        await deliver_all(send_once(sent, "text", target, lambda target=target: send_to_telegram(
+            text,
+            sender_name=message.sender_name,
+            chat_name=message.chat_name,
+            escape=False,
+            target=target
+        )) for target in targets)
+    await send_attachments(
+        client, message.attaches,
+        chat_id=message.chat_id, message_id=message.message_id,
+        sender_name=message.sender_name, chat_name=message.chat_name, targets=targets, sent=sent
+    )
+
+
+async def handle_max_message(client, data, groups):
+    account = client.account
     try:
-        await websocket.send(json.dumps(request))
-        data = await asyncio.wait_for(future, timeout=5.0)
-        if data.get("opcode") == 32 and data.get("payload", {}).get("contacts"):
-            for contact in data["payload"]["contacts"]:
-                if str(contact.get("id")) == sender_id:
-                    name = contact.get("names", [{}])[0].get("name", sender_id)
-                    _name_cache[sender_id] = name
-                    return name
+        if data.get("opcode") not in (64, 128):  # личные и групповые
+            return
+        targets = _router.route(account, data)
+        if not targets:
+            return
+        message = await normalize_message(client, data, groups)
+        # что уже ушло, помним в самом сообщении: повтор после DeliveryFailed это пропустит
+        await forward_message(client, message, targets, sent=data.setdefault("_sent", []))
+    except DeliveryFailed:
+        raise
     except Exception as e:
-        print(f"Ошибка при запросе имени ({sender_id}): {e}")
-    finally:
-        _dispatcher.pop(s_seq, None)
-    return sender_id
+        log.exception(f"Критическая ошибка при обработке сообщения: {e}", extra={"account": account.name})
 
 
-async def handle_max_message(websocket, data, groups):
-    try:
-        opcode = data.get("opcode")
-        
-        if opcode == 64:  # личные
-            sender = str(data["payload"]["message"]["sender"])
-            text = data["payload"]["message"].get("text", "")
-            if text:
-                text = text.replace("<", "&lt;").replace(">", "&gt;")
-            
-            attaches = data["payload"]["message"].get("attaches", [])
-            if attaches is None: attaches = []
-
-            link = data["payload"]["message"].get("link")
-            if link and link.get("type") == "FORWARD" and link.get("message"):
-                fwd_msg = link["message"]
-                fwd_sender_id = str(fwd_msg.get("sender"))
-                fwd_sender_name = await get_user_name(websocket, fwd_sender_id)
-                fwd_text = fwd_msg.get("text", "")
-                
-                if fwd_text:
-                    fwd_text = fwd_text.replace("<", "&lt;").replace(">", "&gt;")
-                
-                text = (text or "") + f"\n\n↩️ <b>Переслано от {fwd_sender_name}:</b>\n{fwd_text}"
-                
-                if fwd_msg.get("attaches"):
-                    attaches.extend(fwd_msg["attaches"])
-            
-            sender_name = await get_user_name(websocket, sender)
-            if text or not attaches:
-                await send_to_telegram(
-                    text,
-                    sender_name=sender_name,
-                    escape=False
-                )
-            await send_attachments(
-                websocket, attaches, 
-                chat_id=sender, message_id=data["payload"]["message"]["id"],
-                sender_name=sender_name
-            )
+def coalesce_size(data):
+    """Сколько символов займёт сообщение в склейке, или None, если его склеивать нельзя.
+
+    Склеиваем только непустые тексты без вложений и пересылок: у остальных своя отрисовка.
+    """
+    if data.get("opcode") not in (64, 128):
+        return None
+    message = (data.get("payload") or {}).get("message") or {}
+    text = (message.get("text") or "").strip()
+    if not text or message.get("attaches") or message.get("link"):
+        return None
+    # запас на заголовок с именем и экранирование
+    return len(text) + 80
+
+
+def split_coalesced(parts, header, limit=COALESCE_MAX_CHARS):
+    """Раскладывает куски по сообщениям не длиннее limit, в начале каждого header."""
+    chunks = []
+    current = header
+    for part in parts:
+        if current != header and len(current) + 2 + len(part) > limit:
+            chunks.append(current)
+            current = header
+        current = f"{current}\n\n{part}" if current else part
+    if current != header:
+        chunks.append(current)
+    return chunks
+
+
+async def handle_max_batch(client, batch, groups):
+    """Несколько коротких текстов одного чата подряд уходят одним сообщением, имена отправителей - в тексте.
+
+    Маршрут у каждого сообщения свой: в каждую цель склеиваются только те, что туда и идут.
+    """
+    account = client.account
+    routes = [_router.route(account, data) for data in batch]
+    if not any(routes):
+        return
+    first = batch[0]
+    header = ""
+    if first.get("opcode") == 128:
+        chat_id = str(first["payload"]["chatId"])
+        chat_name = groups.get(chat_id) or _cache.get("chat", chat_id) or chat_id
+        header = f"💬 <b>{html.escape(chat_name, quote=False)}</b>"
+
+    names = await asyncio.gather(
+        *(get_user_name(client, str(data["payload"]["message"]["sender"])) for data in batch)
+    )
+    sent = first.setdefault("_sent", [])
+    by_target = {}
+    for data, name, targets in zip(batch, names, routes):
+        for target in targets:
+            by_target.setdefault(target, []).append((data, name))
+
+    async def send(target, items):
+        parts = []
+        previous = None
+        for data, name in items:
+            text = html.escape(data["payload"]["message"]["text"].strip(), quote=False)
+            if name == previous:
+                # подряд от одного человека - без повторного заголовка
+                parts[-1] += f"\n{text}"
+                continue
+            previous = name
+            parts.append(f"👤 <b>{html.escape(name, quote=False)}</b>\n{text}")
+        for i, chunk in enumerate(split_coalesced(parts, header)):
+            await send_once(sent, f"chunk{i}", target, lambda: send_to_telegram(chunk, escape=False, target=target))
+
+    await deliver_all(send(target, items) for target, items in by_target.items())
+
+
+def lane_key(data):
+    """Ключ полосы доставки: сообщения одного чата Max пересылаются строго по очереди."""
+    payload = data.get("payload") or {}
+    chat_id = payload.get("chatId")
+    if chat_id is not None:
+        return str(chat_id)
+    return f"user:{(payload.get('message') or {}).get('sender')}"
+
+
+class ForwardPool:
+    """Ограниченная очередь входящих сообщений Max и пул воркеров, которые их пересылают.
+
+    Сообщения раскладываются по полосам (lane_key): внутри полосы порядок строгий, одну полосу
+    в каждый момент ведёт максимум один воркер, разные чаты идут параллельно. Пустая полоса удаляется.
+
+    Что делать, когда в очереди maxsize сообщений, решает overflow:
+    block - put ждёт места (ждёт задача приёма аккаунта, читатель вебсокета работает дальше),
+    drop_oldest - выкидываем самое старое сообщение из всех полос,
+    spill - лишнее дописываем в файл и дочитываем оттуда, когда очередь разгрузится (переживает рестарт).
+    Файл только растёт, докуда он прочитан, лежит рядом в spill_path.offset; весь прочитанный файл удаляется.
+    Чтение и запись файла идут в потоках, цикл событий (и читатель вебсокета) их не ждёт.
+
+    С coalesce_window воркер, взявший короткий текст, ждёт до coalesce_window секунд следующие тексты
+    той же полосы и отдаёт их batch_handler пачкой.
+    """
+
+    def __init__(self, handler, workers=FORWARD_WORKERS, maxsize=FORWARD_QUEUE_SIZE,
+                 overflow=FORWARD_OVERFLOW, spill_path=FORWARD_SPILL_PATH,
+                 batch_handler=None, coalesce_window=COALESCE_WINDOW_MS / 1000):
+        self.handler = handler
+        self.batch_handler = batch_handler
+        self.coalesce_window = coalesce_window if batch_handler is not None else 0
+        self.journal = None
+        self.workers = workers
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.spill_path = spill_path
+        self.depth = 0
+        self.client = None
+        self.groups = {}
+        self.dropped = 0
+        self.spilled = 0
+        self._lanes = {}  # {ключ: deque[(номер, data)]}
+        self._scheduled = set()  # полосы, которые ждут в _ready или сейчас у воркера
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._bound = asyncio.Event()
+        self._arrived = asyncio.Event()
+        self._counter = 0
+        self._busy = {}  # {номер воркера: когда начал}
+        self._busy_time = 0.0
+        self._report_at = time.monotonic()
+        self._tasks = []
+        self._spill_file = None  # открыт на дозапись (aiofiles), пока в файле что-то есть
+        self._spill_offset = 0  # докуда файл уже прочитан, байт
+        self._spill_lock = asyncio.Lock()
+        self._refilling = None
+
+        if overflow == "spill" and os.path.exists(spill_path):
+            if os.path.exists(f"{spill_path}.offset"):
+                with open(f"{spill_path}.offset", encoding="utf-8") as f:
+                    self._spill_offset = int(f.read().strip() or 0)
+            with open(spill_path, "rb") as f:
+                f.seek(self._spill_offset)
+                self.spilled = sum(1 for line in f if line.strip())
+            if self.spilled:
+                log.info(f"В {spill_path} осталось {self.spilled} сообщений с прошлого запуска, перешлём после подключения")
+
+    def start(self):
+        for i in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker(i)))
+
+    async def stop(self):
+        if self._refilling is not None:
+            self._tasks.append(self._refilling)
+            self._refilling = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._spill_file is not None:
+            await self._spill_file.close()
+            self._spill_file = None
+
+    def bind(self, client, groups):
+        # воркеры всегда работают через текущее соединение, старые сообщения после реконнекта тоже
+        self.client = client
+        self.groups = groups
+        self._bound.set()
+        if self.spilled:
+            self._schedule_refill()
 
-        elif opcode == 128:  # групповые
-            chat_id = str(data["payload"]["chatId"])
-            message_id = data["payload"]["message"]["id"]
-            if MAX_ALLOWED_CHAT_IDS and chat_id not in MAX_ALLOWED_CHAT_IDS:
+    def discard_spill(self):
+        # всё, что лежит в файле, есть и в журнале, он и перешлёт
+        if self.spilled:
+            self._remove_spill()
+            self._spill_offset = 0
+            self.spilled = 0
+
+    async def put(self, data):
+        if self.overflow == "spill" and (self.spilled or self.depth >= self.maxsize):
+            # пока в файле что-то лежит, новые сообщения тоже идут туда, иначе поломается порядок
+            await self._spill(data)
+            return
+        if self.overflow == "drop_oldest" and self.depth >= self.maxsize:
+            self._drop_oldest()
+        while self.depth >= self.maxsize:
+            self._space.clear()
+            await self._space.wait()
+        self._enqueue(data)
+
+    def stats(self):
+        return {
+            "queue_depth": self.depth,
+            "queue_size": self.maxsize,
+            "lanes": len(self._lanes),
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "busy_workers": len(self._busy),
+            "workers": self.workers,
+            "utilisation": len(self._busy) / self.workers,
+        }
+
+    def _enqueue(self, data):
+        key = lane_key(data)
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = collections.deque()
+        self._counter += 1
+        lane.append((self._counter, data))
+        self.depth += 1
+        self._arrived.set()
+        if key not in self._scheduled:
+            self._scheduled.add(key)
+            self._ready.put_nowait(key)
+
+    def _drop_oldest(self):
+        # самое старое сообщение - голова одной из полос, ищем только при переполнении
+        candidates = [lane for lane in self._lanes.values() if lane]
+        if not candidates:
+            return
+        _, data = min(candidates, key=lambda lane: lane[0][0]).popleft()
+        if self.journal is not None:
+            # выброшено сознательно, при рестарте не повторяем
+            self.journal.done(data)
+        self.depth -= 1
+        self.dropped += 1
+        if self.dropped % 100 == 1:
+            log.warning(f"Очередь пересылки переполнена, выброшено сообщений: {self.dropped}")
+
+    async def _spill(self, data):
+        # счётчик растёт сразу: следующие put, пока эта запись ждёт, тоже пойдут в файл, за ней
+        self.spilled += 1
+        line = json_dumps(data) + "\n"
+        async with self._spill_lock:
+            if self._spill_file is None:
+                self._spill_file = await aiofiles.open(self.spill_path, "a", encoding="utf-8")
+            await self._spill_file.write(line)
+
+    def _schedule_refill(self):
+        if self._refilling is None or self._refilling.done():
+            self._refilling = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        async with self._spill_lock:
+            room = max(self.maxsize - self.depth, 0)
+            if not room or not self.spilled:
                 return
+            if self._spill_file is not None:
+                await self._spill_file.flush()
+            lines, self._spill_offset = await asyncio.to_thread(self._read_spill, self._spill_offset, room)
+            for line in lines:
+                self._enqueue(json_loads(line))
+            self.spilled -= len(lines)
+            if not self.spilled:
+                # всё прочитано и дописывать нечего - файл больше не нужен
+                if self._spill_file is not None:
+                    await self._spill_file.close()
+                    self._spill_file = None
+                await asyncio.to_thread(self._remove_spill)
+                self._spill_offset = 0
 
-            sender = str(data["payload"]["message"]["sender"])
-            text = data["payload"]["message"].get("text", "")
-            if text:
-                text = text.replace("<", "&lt;").replace(">", "&gt;")
-                
-            attaches = data["payload"]["message"].get("attaches", [])
-            if attaches is None: attaches = []
-
-            link = data["payload"]["message"].get("link")
-            if link and link.get("type") == "FORWARD" and link.get("message"):
-                fwd_msg = link["message"]
-                fwd_sender_id = str(fwd_msg.get("sender"))
-                fwd_sender_name = await get_user_name(websocket, fwd_sender_id)
-                fwd_text = fwd_msg.get("text", "")
-                
-                if fwd_text:
-                    fwd_text = fwd_text.replace("<", "&lt;").replace(">", "&gt;")
-                
-                text = (text or "") + f"\n\n↩️ <b>Переслано от {fwd_sender_name}:</b>\n{fwd_text}"
-                
-                if fwd_msg.get("attaches"):
-                    attaches.extend(fwd_msg["attaches"])
-            
-            chat_name = groups.get(chat_id, chat_id)
-            sender_name = await get_user_name(websocket, sender)
-
-            if text or not attaches:
-                await send_to_telegram(
-                    text,
-                    sender_name=sender_name,
-                    chat_name=chat_name,
-                    escape=False
+    def _read_spill(self, offset, count):
+        """До count строк с offset. Возвращает их и новый offset, который тут же сохраняет рядом с файлом."""
+        lines = []
+        with open(self.spill_path, "rb") as f:
+            f.seek(offset)
+            while len(lines) < count:
+                line = f.readline()
+                if not line:
+                    break
+                if line.strip():
+                    lines.append(line)
+            offset = f.tell()
+        with open(f"{self.spill_path}.offset", "w", encoding="utf-8") as f:
+            f.write(str(offset))
+        return lines, offset
+
+    def _remove_spill(self):
+        for path in (self.spill_path, f"{self.spill_path}.offset"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    async def _worker(self, index):
+        while True:
+            key = await self._ready.get()
+            lane = self._lanes[key]
+            if not lane:
+                # всё из полосы выкинул drop_oldest
+                del self._lanes[key]
+                self._scheduled.discard(key)
+                continue
+
+            _, data = lane.popleft()
+            self.depth -= 1
+            self._space.set()
+            await self._bound.wait()
+            self._busy[index] = time.monotonic()
+            try:
+                batch = [data]
+                if self.coalesce_window and coalesce_size(data) is not None:
+                    batch = await self._coalesce(lane, data)
+                await self._deliver(batch)
+            finally:
+                self._busy_time += time.monotonic() - self._busy.pop(index)
+                if lane:
+                    # в конец очереди готовых, чтобы болтливый чат не занимал воркер вечно
+                    self._ready.put_nowait(key)
+                else:
+                    del self._lanes[key]
+                    self._scheduled.discard(key)
+            if self.spilled and self.client is not None and self.depth <= self.maxsize // 2:
+                self._schedule_refill()
+
+    async def _coalesce(self, lane, data):
+        """Добирает из полосы идущие подряд короткие тексты, пока не выйдет окно или место.
+
+        Сообщение с вложением прерывает склейку сразу: оно уйдёт следующим, порядок не меняется.
+        """
+        batch = [data]
+        size = coalesce_size(data)
+        deadline = time.monotonic() + self.coalesce_window
+        while len(batch) < COALESCE_MAX_MESSAGES:
+            if lane:
+                next_size = coalesce_size(lane[0][1])
+                if next_size is None or size + next_size > COALESCE_MAX_CHARS:
+                    break
+                _, next_data = lane.popleft()
+                self.depth -= 1
+                self._space.set()
+                batch.append(next_data)
+                size += next_size
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _deliver(self, batch):
+        account = self.client.account.name
+        # повторяем в той же полосе, чтобы не сломать порядок внутри чата
+        for attempt in range(1, FORWARD_MAX_ATTEMPTS + 1):
+            try:
+                if len(batch) == 1:
+                    await self.handler(self.client, batch[0], self.groups)
+                else:
+                    await self.batch_handler(self.client, batch, self.groups)
+                    COALESCED.inc(account, amount=len(batch))
+                FORWARDED.inc(account, amount=len(batch))
+                now = time.time()
+                for data in batch:
+                    FORWARD_LATENCY.observe(now - data.get("_received", now), account)
+                break
+            except DeliveryFailed as e:
+                if attempt == FORWARD_MAX_ATTEMPTS:
+                    log.error(f"Сообщение так и не доставлено после {attempt} попыток: {e}")
+                    FORWARD_FAILED.inc(account, amount=len(batch))
+                    break
+                log.warning(f"Сообщение не доставлено ({e}), попытка {attempt}/{FORWARD_MAX_ATTEMPTS}, ждём {FORWARD_RETRY_DELAY} с")
+                await asyncio.sleep(FORWARD_RETRY_DELAY)
+            except Exception as e:
+                log.exception(f"Ошибка в воркере пересылки: {e}", extra={"account": account})
+                FORWARD_FAILED.inc(account, amount=len(batch))
+                break
+        if self.journal is not None:
+            for data in batch:
+                self.journal.done(data)
+
+    def report(self):
+        now = time.monotonic()
+        busy_time = self._busy_time + sum(now - started for started in self._busy.values())
+        self._busy_time = -sum(now - started for started in self._busy.values())
+        utilisation = busy_time / (max(now - self._report_at, 1e-9) * self.workers)
+        self._report_at = now
+        s = self.stats()
+        return (
+            f"Очередь пересылки: {s['queue_depth']}/{s['queue_size']} в {s['lanes']} чатах, "
+            f"в файле {s['spilled']}, выброшено {s['dropped']}, "
+            f"занято воркеров {s['busy_workers']}/{s['workers']}, загрузка за период {utilisation:.0%}"
+        )
+
+
+def journal_key(data):
+    message_id = ((data.get("payload") or {}).get("message") or {}).get("id")
+    if message_id is None:
+        return None
+    return f"{lane_key(data)}:{message_id}"
+
+
+class Journal:
+    """Журнал входящих сообщений в sqlite (WAL) между вебсокетом Max и ForwardPool.
+
+    Сообщение попадает в очередь только после коммита в журнал, после отправки в телеграм помечается
+    доставленным, недоставленное при старте пересылается заново. Повтор того же id из Max игнорируется.
+    Коммиты групповые: всё, что накопилось за JOURNAL_COMMIT_MS, пишется одной транзакцией в отдельном потоке.
+    Не записалось (диск полон, ошибка ввода-вывода) - пачка возвращается в буфер и пишется снова с паузой,
+    а если журнал не пишется FALLBACK_AFTER раз подряд, сообщения идут в очередь мимо него, чтобы пересылка не встала.
+    """
+
+    FALLBACK_AFTER = 3
+
+    def __init__(self, pool, path=JOURNAL_PATH):
+        self.pool = pool
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "key TEXT PRIMARY KEY, data TEXT NOT NULL, done INTEGER NOT NULL DEFAULT 0, created REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._buffer = {}  # {key: data} ждут коммита
+        self._done = []
+        self._wakeup = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._pruned_at = 0.0
+        self._task = None
+        pool.journal = self
+        self._replay = self._pending()
+        if self._replay:
+            log.info(f"В журнале {len(self._replay)} недоставленных сообщений, пересылаем")
+            pool.discard_spill()
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        # то, что не успели закоммитить, Max всё равно не подтвердили, а отметки о доставке сохраним
+        if self._done:
+            try:
+                await asyncio.to_thread(self._write, {}, self._done)
+            except sqlite3.Error as e:
+                log.warning(f"Не удалось сохранить отметки о доставке в журнал: {e}")
+            self._done = []
+        self._db.close()
+
+    async def append(self, data):
+        key = journal_key(data)
+        if key is None:
+            await self.pool.put(data)
+            return
+        self._buffer.setdefault(key, data)
+        if len(self._buffer) >= JOURNAL_BATCH_SIZE:
+            self._wakeup.set()
+            if len(self._buffer) >= JOURNAL_BATCH_SIZE * 4:
+                # журнал не успевает, придерживаем читателя
+                self._drained.clear()
+                await self._drained.wait()
+
+    def done(self, data):
+        key = journal_key(data)
+        if key is not None:
+            self._done.append(key)
+
+    async def _run(self):
+        replay, self._replay = self._replay, []
+        for data in replay:
+            await self.pool.put(data)
+
+        backoff = Backoff(base=JOURNAL_COMMIT_MS / 1000, cap=1)
+        failures = 0
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), JOURNAL_COMMIT_MS / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self._buffer and not self._done:
+                continue
+
+            batch, self._buffer = self._buffer, {}
+            done, self._done = self._done, []
+            self._drained.set()
+            try:
+                fresh = await asyncio.to_thread(self._write, batch, done)
+            except sqlite3.Error as e:
+                failures += 1
+                # пришедшее за время записи - после возвращённой пачки, чтобы не нарушить порядок
+                for key, data in self._buffer.items():
+                    batch.setdefault(key, data)
+                self._buffer = batch
+                self._done = done + self._done
+                if failures < self.FALLBACK_AFTER:
+                    log.warning(f"Не удалось записать журнал ({len(batch)} сообщений), повторим: {e}")
+                else:
+                    log.error(f"Журнал не пишется {failures} раз подряд, {len(batch)} сообщений идут в очередь без него: {e}")
+                    self._buffer = {}
+                    self._drained.set()
+                    for data in batch.values():
+                        await self.pool.put(data)
+                await asyncio.sleep(backoff.next())
+                continue
+            failures = 0
+            backoff.reset()
+            for key in fresh:
+                await self.pool.put(batch[key])
+
+    def _pending(self):
+        rows = self._db.execute("SELECT data FROM journal WHERE done = 0 ORDER BY rowid").fetchall()
+        return [json_loads(row[0]) for row in rows]
+
+    def _write(self, batch, done):
+        """Одна транзакция на пачку. Возвращает ключи, которых в журнале ещё не было."""
+        fresh = []
+        now = time.time()
+        with self._db:
+            for key, data in batch.items():
+                cur = self._db.execute(
+                    "INSERT OR IGNORE INTO journal (key, data, created) VALUES (?, ?, ?)",
+                    (key, json_dumps(data), now)
                 )
-            await send_attachments(
-                websocket, attaches, 
-                chat_id=chat_id, message_id=message_id,
-                sender_name=sender_name, chat_name=chat_name
-            )
+                if cur.rowcount:
+                    fresh.append(key)
+            self._db.executemany("UPDATE journal SET done = 1 WHERE key = ?", [(key,) for key in done])
+            if time.monotonic() - self._pruned_at > 3600:
+                self._pruned_at = time.monotonic()
+                self._db.execute(
+                    "DELETE FROM journal WHERE done = 1 AND created < ?", (now - JOURNAL_KEEP_SECONDS,)
+                )
+        return fresh
+
+
+async def fetch_history(client, chat_id, from_time, count):
+    payload = {
+        "chatId": int(chat_id),
+        "from": from_time,
+        "forward": count,
+        "backward": 0,
+        "getMessages": True
+    }
+    try:
+        data = await client.request(49, payload)
+        return data.get("payload", {}).get("messages") or []
     except Exception as e:
-        print(f"Критическая ошибка при обработке сообщения: {e}")
-        import traceback
-        traceback.print_exc()
+        log.warning(f"Ошибка при запросе истории чата {chat_id}: {e}")
+        return []
+
+
+class Backfill:
+    """Помнит последнее увиденное сообщение каждого чата и после (ре)коннекта догоняет пропущенное.
+
+    Пробел видно по lastMessage чатов из ответа на opcode 19. Историю спрашиваем opcode 49 по
+    BACKFILL_CONCURRENCY чатов за раз, живые сообщения такого чата пока придерживаем, чтобы они
+    не обогнали догнанные. Повторы (история пересекается с живыми) отсеиваем по id.
+    """
+
+    def __init__(self, account):
+        self.account = account
+        self._last_seen = {}  # {chat_id: время последнего сообщения, мс}
+        self._dirty = set()
+        self._recent = collections.OrderedDict()  # недавние journal_key для отсева повторов
+        self._holding = {}  # {chat_id: [data]} живые сообщения чатов, которые сейчас догоняем
+        self._owner = {}  # {chat_id: запуск _run, который отпустит придержанное}
+        self._task = None
+        self._flushed_at = time.monotonic()
+
+    def accept(self, data):
+        key = journal_key(data)
+        if key is not None:
+            if key in self._recent:
+                return
+            self._recent[key] = None
+            if len(self._recent) > 10000:
+                self._recent.popitem(last=False)
+
+        chat_id = (data.get("payload") or {}).get("chatId")
+        if chat_id is not None:
+            chat_id = str(chat_id)
+            held = self._holding.get(chat_id)
+            if held is not None:
+                held.append(data)
+                return
+            self._seen(chat_id, data)
+        self.account.submit(data)
+
+    def start(self, client, chats):
+        if self._task is not None and not self._task.done():
+            self._task.cancel()
+        gaps = []
+        for chat in chats:
+            chat_id = str(chat.get("id"))
+            last_time = ((chat.get("lastMessage") or {}).get("time")) or 0
+            seen = self.last_seen(chat_id)
+            if seen and last_time > seen:
+                # из истории собираем такой же кадр, какой пришёл бы вживую: личные - opcode 64
+                opcode = 64 if chat.get("type") == "DIALOG" else 128
+                gaps.append((chat_id, seen, opcode))
+        if gaps and BACKFILL_MAX_MESSAGES:
+            log.info(f"Догоняем пропущенные сообщения в {len(gaps)} чатах")
+            run = object()
+            for chat_id, _, _ in gaps:
+                # придержанное прошлым запуском не теряем, отпустит его уже этот
+                self._holding.setdefault(chat_id, [])
+                self._owner[chat_id] = run
+            self._task = asyncio.create_task(self._run(client, gaps, run))
+
+    def last_seen(self, chat_id):
+        if chat_id not in self._last_seen:
+            cached = _cache.get("seen", self.account.cache_key(chat_id))
+            self._last_seen[chat_id] = int(cached) if cached else 0
+        return self._last_seen[chat_id]
+
+    def flush(self):
+        if self._dirty:
+            _cache.set_many("seen", [(self.account.cache_key(cid), str(self._last_seen[cid])) for cid in self._dirty])
+            self._dirty.clear()
+        self._flushed_at = time.monotonic()
+
+    def _seen(self, chat_id, data):
+        msg_time = ((data.get("payload") or {}).get("message") or {}).get("time") or int(time.time() * 1000)
+        if msg_time > self.last_seen(chat_id):
+            self._last_seen[chat_id] = msg_time
+            self._dirty.add(chat_id)
+        if time.monotonic() - self._flushed_at > 5:
+            self.flush()
+
+    async def _run(self, client, gaps, run):
+        slots = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+
+        async def one(chat_id, since, opcode):
+            try:
+                async with slots:
+                    messages = await fetch_history(client, chat_id, since, BACKFILL_MAX_MESSAGES)
+                    await asyncio.sleep(BACKFILL_REQUEST_DELAY_MS / 1000)
+                messages = sorted(
+                    (m for m in messages if (m.get("time") or 0) > since),
+                    key=lambda m: m.get("time") or 0
+                )
+                if messages:
+                    log.info(f"Чат {chat_id}: догнали {len(messages)} сообщений")
+                for m in messages[:BACKFILL_MAX_MESSAGES]:
+                    data = {"opcode": opcode, "payload": {"chatId": int(chat_id), "message": m}}
+                    key = journal_key(data)
+                    if key in self._recent:
+                        continue
+                    self._recent[key] = None
+                    self._seen(chat_id, data)
+                    self.account.submit(data)
+            finally:
+                # если чат перехватил новый запуск start(), придержанное отпустит он
+                if self._owner.get(chat_id) is run:
+                    del self._owner[chat_id]
+                    # сначала догнанное, потом то, что пришло вживую за это время
+                    for data in self._holding.pop(chat_id, []):
+                        if journal_key(data) is not None:
+                            self._recent.pop(journal_key(data), None)
+                        self.accept(data)
+
+        await asyncio.gather(*(one(chat_id, since, opcode) for chat_id, since, opcode in gaps), return_exceptions=True)
+        self.flush()
+
+
+def account_path(path, name):
+    # у аккаунта по умолчанию пути как раньше, остальным добавляем имя перед расширением
+    if not path or name == "default":
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{name}{ext}"
+
+
+class Account:
+    """Один аккаунт Max: своё соединение, очередь, журнал и догонялка, свой чат в телеграме.
+
+    Загрузчик, планировщик Bot API и кэш у всех аккаунтов процесса общие.
+    """
+
+    def __init__(self, name, token, target, allowed_chat_ids=()):
+        self.name = name
+        self.token = token
+        self.target = target
+        self.allowed_chat_ids = set(allowed_chat_ids)
+        self.pool = ForwardPool(handle_max_message, spill_path=account_path(FORWARD_SPILL_PATH, name),
+                                batch_handler=handle_max_batch)
+        self.journal = Journal(self.pool, account_path(JOURNAL_PATH, name)) if JOURNAL_PATH else None
+        self.backfill = Backfill(self)
+        self.names = NameResolver()
+        # буфер между читателем вебсокета и очередью: читатель не ждёт никогда, иначе встанут
+        # ответы на запросы воркеров и пинги, и очередь уже не освободится
+        self.intake = collections.deque()
+        self._intake_ready = asyncio.Event()
+        self._intake_task = None
+
+    def cache_key(self, key):
+        return str(key) if self.name == "default" else f"{self.name}:{key}"
+
+    def submit(self, data):
+        # время получения едет вместе с сообщением (и через журнал), по нему считается задержка пересылки
+        data.setdefault("_received", time.time())
+        if len(self.intake) >= FORWARD_INTAKE_SIZE:
+            self.pool.dropped += 1
+            if self.pool.dropped % 100 == 1:
+                log.warning(f"[{self.name}] Буфер приёма переполнен ({FORWARD_INTAKE_SIZE}), выброшено сообщений: {self.pool.dropped}",
+                            extra={"account": self.name})
+            return
+        self.intake.append(data)
+        self._intake_ready.set()
+
+    async def _run_intake(self):
+        while True:
+            while not self.intake:
+                self._intake_ready.clear()
+                await self._intake_ready.wait()
+            data = self.intake.popleft()
+            if self.journal is not None:
+                await self.journal.append(data)
+            else:
+                await self.pool.put(data)
+
+    def start(self):
+        if self.journal is not None:
+            self.journal.start()
+        self.pool.start()
+        self._intake_task = asyncio.create_task(self._run_intake())
+
+    async def stop(self):
+        if self._intake_task is not None:
+            self._intake_task.cancel()
+            await asyncio.gather(self._intake_task, return_exceptions=True)
+            self._intake_task = None
+        await self.pool.stop()
+        if self.journal is not None:
+            await self.journal.stop()
+        self.backfill.flush()
+
+
+def load_accounts():
+    if not MAX_ACCOUNTS_FILE:
+        return [{"name": "default", "token": MAX_TOKEN, "telegram_chat_id": TELEGRAM_CHAT_ID,
+                 "telegram_thread_id": TELEGRAM_THREAD_ID, "allowed_chat_ids": sorted(MAX_ALLOWED_CHAT_IDS)}]
+    with open(MAX_ACCOUNTS_FILE, encoding="utf-8") as f:
+        accounts = json.load(f)
+    names = set()
+    for i, acc in enumerate(accounts):
+        acc.setdefault("name", f"account{i + 1}")
+        if not acc.get("token"):
+            raise RuntimeError(f"У аккаунта {acc['name']} в {MAX_ACCOUNTS_FILE} не указан token")
+        if acc["name"] in names:
+            raise RuntimeError(f"Имя аккаунта {acc['name']} в {MAX_ACCOUNTS_FILE} повторяется")
+        names.add(acc["name"])
+        if "telegram_chat_id" not in acc:
+            # чат не указан - шлём туда же, куда и основной аккаунт, в ту же тему
+            acc["telegram_chat_id"] = TELEGRAM_CHAT_ID
+            acc.setdefault("telegram_thread_id", TELEGRAM_THREAD_ID)
+        if not acc["telegram_chat_id"]:
+            raise RuntimeError(f"У аккаунта {acc['name']} не указан telegram_chat_id, а TELEGRAM_CHAT_ID пуст")
+    return accounts
+
 
+def build_account(config):
+    target = Target(str(config["telegram_chat_id"]), parse_thread_id(config.get("telegram_thread_id")))
+    allowed = {str(cid).strip() for cid in config.get("allowed_chat_ids") or [] if str(cid).strip()}
+    return Account(config["name"], config["token"], target, allowed)
 
-async def connect_to_max(maxtoken):
+
+def collect_gauges(accounts):
+    for account in accounts:
+        client = account.pool.client
+        RPC_IN_FLIGHT.set(client.in_flight if client is not None else 0, account.name)
+        QUEUE_DEPTH.set(account.pool.depth + len(account.intake), account.name)
+        QUEUE_SPILLED.set(account.pool.spilled, account.name)
+        QUEUE_DROPPED.set(account.pool.dropped, account.name)
+        BUSY_WORKERS.set(len(account.pool._busy), account.name)
+    DOWNLOADS_IN_FLIGHT.set(
+        GLOBAL_DOWNLOAD_CONCURRENCY - _download_slots._value + LARGE_TRANSFER_CONCURRENCY - _large_download_slots._value
+    )
+    UPLOADS_IN_FLIGHT.set(UPLOAD_CONCURRENCY - _upload_slots._value + LARGE_TRANSFER_CONCURRENCY - _large_upload_slots._value)
+    TASKS.set(len(asyncio.all_tasks()))
+    for result, value in _media_cache.stats().items():
+        MEDIA_CACHE.set(value, result)
+
+
+async def start_metrics_server(accounts, port):
+    """Поднимает /metrics в формате Prometheus. Возвращает runner, его надо закрыть через cleanup()."""
+    async def metrics(request):
+        collect_gauges(accounts)
+        body = "\n".join(line for metric in METRICS for line in metric.render()) + "\n"
+        return aiohttp.web.Response(text=body, content_type="text/plain", charset="utf-8")
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = aiohttp.web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, METRICS_HOST, port).start()
+    log.info(f"Метрики: http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
+
+async def stats_reporter(accounts):
+    while True:
+        await asyncio.sleep(FORWARD_STATS_INTERVAL)
+        for account in accounts:
+            log.info(f"[{account.name}] {account.pool.report()}, в буфере приёма {len(account.intake)}", extra={"account": account.name})
+        log.info(_telegram_scheduler.report())
+        log.info(_media_cache.report())
+
+
+# opcode, которые мы разбираем; остальное (присутствие, "печатает" и т.п.) выкидываем не парся
+HANDLED_OPCODES = frozenset((19, 64, 128))
+_HEADER_FIELD = re.compile(r'"(opcode|seq)"\s*:\s*"?(-?\d+)')
+
+
+def peek_header(frame):
+    """opcode и seq кадра без разбора payload. None - заголовок не нашёлся, кадр надо парсить целиком."""
+    if not isinstance(frame, str):
+        return None
+    # у Max payload идёт последним, всё до него - короткий заголовок
+    end = frame.find('"payload"')
+    fields = dict(_HEADER_FIELD.findall(frame if end < 0 else frame[:end]))
+    if "opcode" not in fields:
+        return None
+    return int(fields["opcode"]), fields.get("seq")
+
+
+async def read_max_frames(websocket, client, groups):
+    account = client.account
     while True:
         try:
-            async with websockets.connect(
-                MAX_WS_URI,
-                origin=MAX_WS_ORIGIN,
-                additional_headers={"User-Agent": "Mozilla/5.0"}
-            ) as websocket: # тут подключение вебсокета вообще рофл ну и пусть будет как будто можно и получше сделать вообще хз честно говоря
-                # первое сообщение
-                first_message = {
-                    "ver": 11,
-                    "cmd": 0,
-                    "seq": 2,
-                    "opcode": 6,
-                    "payload": {
-                        "userAgent": {
-                            "deviceType": "WEB",
-                            "locale": "ru",
-                            "deviceLocale": "en",
-                            "osVersion": "Linux",
-                            "deviceName": "Firefox",
-                            "headerUserAgent": "Mozilla/5.0",
-                            "appVersion": "25.7.11",
-                            "screen": "827x1323 1.9x",
-                            "timezone": "Europe/Moscow"
-                        },
-                        "deviceId": "device id"
-                    }
-                }
-                await websocket.send(json.dumps(first_message))
-                await websocket.recv()
-
-                # второе сообщение
-                second_message = {
-                    "ver": 11,
-                    "cmd": 0,
-                    "seq": 3,
-                    "opcode": 19,
-                    "payload": {
-                        "interactive": False,
-                        "token": maxtoken,
-                        "chatsSync": 0,
-                        "contactsSync": 0,
-                        "presenceSync": 0,
-                        "draftsSync": 0,
-                        "chatsCount": 40
-                    }
-                }
-                await websocket.send(json.dumps(second_message))
+            message = await websocket.recv()
+            header = peek_header(message)
+            if header is not None:
+                FRAMES.inc(account.name, header[0])
+                if header[0] not in HANDLED_OPCODES and not client.expects(header[1]):
+                    continue
+            data = json_loads(message)
+            if header is None:
+                FRAMES.inc(account.name, data.get("opcode"))
 
-                groups = {}
+            if client.dispatch(data):
+                continue
+
+            # основная обработка по opcode
+            opcode = data.get("opcode")
+            if opcode == 19:
+                for chat in data["payload"].get("chats", []):
+                    if chat.get("type") == "CHAT":
+                        groups[str(chat["id"])] = chat.get("title", str(chat["id"]))
+                _cache.set_many("chat", groups.items())
+                log.info("Группы обновлены: %s", groups, extra={"account": account.name})
+                account.backfill.start(client, data["payload"].get("chats", []))
+                # имена из логина, чтобы первые сообщения не ждали opcode 32
+                remember_contacts(data["payload"].get("contacts"))
+                profile = data["payload"].get("profile") or {}
+                remember_contacts([profile.get("contact") or {}])
+
+            elif opcode in [64, 128]:
+                account.backfill.accept(data)
 
-                while True:
-                    try:
-                        message = await websocket.recv()
-                        data = json.loads(message)
-                        
-                        msg_seq = data.get("seq")
-                        if msg_seq is not None:
-                            s_seq = str(msg_seq)
-                            if s_seq in _dispatcher:
-                                _dispatcher[s_seq].set_result(data)
-                                continue
-
-                        # основная обработка по opcode
-                        opcode = data.get("opcode")
-                        if opcode == 19:
-                            for chat in data["payload"].get("chats", []):
-                                if chat.get("type") == "CHAT":
-                                    groups[str(chat["id"])] = chat.get("title", str(chat["id"]))
-                            print("Группы обновлены:", groups)
-                        
-                        elif opcode in [64, 128]:
-                            asyncio.create_task(handle_max_message(websocket, data, groups))
-
-                    except ConnectionClosed as e:
-                        print(f"Соединение оборвано: {e}")
-                        raise
-                    except Exception as e:
-                        print(f"Ошибка при обработке сообщения: {e}")
         except ConnectionClosed as e:
-            print(f"Оборвано соединение: {e}. Пробуем еще раз через {RECONNECT_DELAY} секунд.")
+            log.warning(f"Соединение оборвано: {e}", extra={"account": account.name})
+            raise
         except Exception as e:
-            print(f"Ошибка соединения: {e}. Пробуем еще раз через {RECONNECT_DELAY} секунд.")
+            log.exception(f"Ошибка при обработке сообщения: {e}", extra={"account": account.name})
+
+
+class Backoff:
+    """Паузы между переподключениями: первая попытка сразу, дальше base * 2^n со случайным разбросом (full jitter).
 
-        await asyncio.sleep(RECONNECT_DELAY)
+    Разброс нужен, чтобы аккаунты, отвалившиеся разом, не ломились обратно одновременно.
+    """
 
+    def __init__(self, base=RECONNECT_BASE_DELAY_MS / 1000, cap=RECONNECT_MAX_DELAY):
+        self.base = base
+        self.cap = cap
+        self.attempt = 0
 
-async def main():
+    def next(self):
+        attempt, self.attempt = self.attempt, self.attempt + 1
+        if attempt == 0:
+            return 0
+        return random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+
+    def reset(self):
+        self.attempt = 0
+
+
+class MaxConnection:
+    """Соединение аккаунта с Max: подключение, рукопожатие, пинги, переподключение.
+
+    Мёртвое соединение замечаем по пингам: вебсокет пингует сам, а раз в MAX_PING_INTERVAL идёт opcode 1,
+    и если Max не ответил за MAX_PING_TIMEOUT, соединение бросаем, не дожидаясь TCP.
+    С MAX_STANDBY рядом держится запасной сокет с уже пройденным opcode 6: после обрыва на него
+    остаётся только залогиниться. Пропущенное за время обрыва догоняет Backfill после логина.
+    """
+
+    # столько должно прожить соединение, чтобы счётчик попыток сбросился
+    STABLE_SECONDS = 10
+
+    def __init__(self, account, standby=MAX_STANDBY):
+        self.account = account
+        self.backoff = Backoff()
+        self.standby = standby
+        self._standby = None  # (websocket, client)
+        self._warmer = None
+        self._closing = set()
+
+    async def open(self):
+        """Новый сокет с пройденным opcode 6. Возвращает (websocket, client)."""
+        websocket = await websockets.connect(
+            MAX_WS_URI,
+            origin=MAX_WS_ORIGIN,
+            additional_headers={"User-Agent": "Mozilla/5.0"},
+            open_timeout=MAX_CONNECT_TIMEOUT,
+            ping_interval=MAX_PING_INTERVAL or None,
+            ping_timeout=MAX_PING_TIMEOUT if MAX_PING_INTERVAL else None,
+            # мёртвый сокет закрываем быстро, переподключение этого не ждёт
+            close_timeout=1,
+        )
+        try:
+            client = MaxClient(websocket, self.account)
+            # первое сообщение
+            hello = {
+                "ver": 11,
+                "cmd": 0,
+                "seq": client.next_seq(),
+                "opcode": 6,
+                "payload": {
+                    "userAgent": {
+                        "deviceType": "WEB",
+                        "locale": "ru",
+                        "deviceLocale": "en",
+                        "osVersion": "Linux",
+                        "deviceName": "Firefox",
+                        "headerUserAgent": "Mozilla/5.0",
+                        "appVersion": "25.7.11",
+                        "screen": "827x1323 1.9x",
+                        "timezone": "Europe/Moscow"
+                    },
+                    "deviceId": "device id"
+                }
+            }
+            await websocket.send(json_dumps(hello))
+            await asyncio.wait_for(websocket.recv(), MAX_CONNECT_TIMEOUT)
+        except BaseException:
+            self.discard(websocket)
+            raise
+        return websocket, client
+
+    async def login(self, websocket, client):
+        # второе сообщение, ответ на него (чаты, контакты) разбирает read_max_frames
+        login = {
+            "ver": 11,
+            "cmd": 0,
+            "seq": client.next_seq(),
+            "opcode": 19,
+            "payload": {
+                "interactive": False,
+                "token": self.account.token,
+                "chatsSync": 0,
+                "contactsSync": 0,
+                "presenceSync": 0,
+                "draftsSync": 0,
+                "chatsCount": 40
+            }
+        }
+        await websocket.send(json_dumps(login))
+
+    def discard(self, websocket):
+        # закрытие мёртвого сокета может занять close_timeout - пусть идёт в фоне
+        task = asyncio.create_task(websocket.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def take_standby(self):
+        standby, self._standby = self._standby, None
+        if self.standby:
+            # взятый запасной сразу заменяем новым
+            if self._warmer is not None:
+                self._warmer.cancel()
+            self._warmer = asyncio.create_task(self._warm())
+        if standby is not None and standby[0].close_code is None:
+            return standby
+        return None
+
+    async def _warm(self):
+        backoff = Backoff()
+        while True:
+            await asyncio.sleep(backoff.next())
+            try:
+                websocket, client = await self.open()
+            except Exception as e:
+                log.debug(f"Запасное соединение не открылось: {e}", extra={"account": self.account.name})
+                continue
+            opened = time.monotonic()
+            self._standby = (websocket, client)
+            await websocket.wait_closed()
+            # Max закрыл простаивающий сокет - откроем новый
+            if self._standby is not None and self._standby[0] is websocket:
+                self._standby = None
+            if time.monotonic() - opened >= self.STABLE_SECONDS:
+                backoff.reset()
+
+    async def heartbeat(self, client):
+        while True:
+            await asyncio.sleep(MAX_PING_INTERVAL)
+            try:
+                await client.request(1, {"interactive": False}, timeout=MAX_PING_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f"Max не ответил на пинг за {MAX_PING_TIMEOUT} с") from None
+
+    async def session(self, websocket, client):
+        account = self.account
+        await self.login(websocket, client)
+        groups = {}
+        account.pool.bind(client, groups)
+        tasks = [asyncio.create_task(read_max_frames(websocket, client, groups))]
+        if MAX_PING_INTERVAL:
+            tasks.append(asyncio.create_task(self.heartbeat(client)))
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            # ждать ответа от мёртвого сокета незачем
+            client.close()
+            self.discard(websocket)
+
+    async def run(self):
+        account = self.account
+        if self.standby:
+            self._warmer = asyncio.create_task(self._warm())
+        try:
+            while True:
+                connected = None
+                reason = "Соединение закрыто"
+                try:
+                    standby = self.take_standby()
+                    websocket, client = standby or await self.open()
+                    connected = time.monotonic()
+                    await self.session(websocket, client)
+                except ConnectionClosed as e:
+                    reason = f"Оборвано соединение: {e}"
+                except Exception as e:
+                    reason = f"Ошибка соединения: {e}"
+                if connected is not None and time.monotonic() - connected >= self.STABLE_SECONDS:
+                    self.backoff.reset()
+                delay = self.backoff.next()
+                RECONNECTS.inc(account.name)
+                log.warning(f"[{account.name}] {reason}. Переподключаемся через {delay:.1f} с.", extra={"account": account.name})
+                await asyncio.sleep(delay)
+        finally:
+            if self._warmer is not None:
+                self._warmer.cancel()
+            if self._standby is not None:
+                self.discard(self._standby[0])
+
+
+async def connect_to_max(account):
+    await MaxConnection(account).run()
+
+
+async def main(configs=None, shard=0):
+    if configs is None:
+        configs = load_accounts()
+    accounts = [build_account(config) for config in configs]
+    for account in accounts:
+        account.start()
+    reporter = asyncio.create_task(stats_reporter(accounts)) if FORWARD_STATS_INTERVAL > 0 else None
+    routes_watcher = asyncio.create_task(_router.watch()) if ROUTES_FILE and ROUTES_RELOAD_INTERVAL else None
+    metrics_runner = await start_metrics_server(accounts, METRICS_PORT + shard) if METRICS_PORT else None
     try:
-        await connect_to_max(MAX_TOKEN)
+        await asyncio.gather(*(connect_to_max(account) for account in accounts))
     except Exception as e:
-        print(f"Ошибка: {e}")
+        log.exception(f"Ошибка: {e}")
     finally:
+        if reporter is not None:
+            reporter.cancel()
+        if routes_watcher is not None:
+            routes_watcher.cancel()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        for account in accounts:
+            await account.stop()
         await bot.session.close()
         if _session and not _session.closed:
             await _session.close()
+        _cache.close()
 
 
-if __name__ == "__main__":
-    asyncio.run(main())
+def run_shard(configs, shard=0, processes=1, chat_shares=None):
+    if processes > 1:
+        _telegram_scheduler.share(processes, chat_shares or {})
+    try:
+        asyncio.run(main(configs, shard))
+    except KeyboardInterrupt:
+        pass
 
+
+def run_sharded(configs, processes):
+    """Раскидывает аккаунты по процессам, у каждого процесса свой бот и загрузчик, лимиты бота делятся между ними."""
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    shards = [configs[i::processes] for i in range(processes)]
+    # сколько процессов шлёт в каждый чат: у них этот чат делит поканальный лимит
+    chat_shares = collections.Counter()
+    for shard in shards:
+        chat_shares.update({str(config["telegram_chat_id"]) for config in shard})
+    workers = [ctx.Process(target=run_shard, args=(shard, i, processes, dict(chat_shares)), name=f"maxresender-{i}")
+               for i, shard in enumerate(shards) if shard]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == "__main__":
+    _configs = load_accounts()
+    if MAX_PROCESSES > 1 and len(_configs) > 1:
+        run_sharded(_configs, min(MAX_PROCESSES, len(_configs)))
+    else:
+        asyncio.run(main(_configs))
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# main читает настройки при импорте: без токенов он не запустится, а кэш и маршруты в тестах не нужны
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:test")
+os.environ.setdefault("TELEGRAM_CHAT_ID", "-100")
+os.environ.setdefault("MAX_TOKEN", "test")
+os.environ["CACHE_PATH"] = ""
+os.environ["ROUTES_FILE"] = ""
+os.environ["LOG_LEVEL"] = "CRITICAL"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,158 @@
+import asyncio
+import itertools
+
+import pytest
+
+import main
+
+LIMIT = 1000
+_ids = itertools.count(1)
+
+
+class File(main.InputFile):
+    """Открытое скачивание вместо StreamingInputFile."""
+
+    def __init__(self, name, size):
+        super().__init__(filename=name)
+        self.size = size
+        self.url = f"http://cdn/{name}"
+        self.closed = False
+
+    async def read(self, bot):
+        yield b"x"
+
+    def close(self):
+        self.closed = True
+
+
+def photo(size=10):
+    return {"_type": "PHOTO", "photoId": next(_ids), "baseUrl": "http://cdn/p", "size": size}
+
+
+def video(size=10):
+    return {"_type": "VIDEO", "videoId": next(_ids), "size": size}
+
+
+@pytest.fixture
+def telegram(monkeypatch, tmp_path):
+    """Подменяет выгрузку в телеграм и скачивание: запоминает, что и куда ушло."""
+    calls = []
+    opened = []
+    failures = {}
+
+    async def prepare_attachment(client, a, filename, chat_id, message_id, message_slots, max_size=None, hold_slot=True):
+        if max_size is not None and a["size"] > max_size:
+            raise main.TooLargeForAlbum(a["size"])
+        if a["size"] > LIMIT:
+            path = tmp_path / f"spool{len(opened)}"
+            path.write_bytes(b"x")
+            f = main.SpooledFile(str(path), filename, a["size"], "http://cdn/big")
+        else:
+            f = File(filename, a["size"])
+        opened.append((a, max_size))
+        return f
+
+    async def fail_or_record(call):
+        error = failures.get(call[:2])
+        if error is not None:
+            failures.pop(call[:2])
+            raise error
+        calls.append(call)
+
+    async def send_media(kind, media, file_name, kb, target, caption=None):
+        await fail_or_record(("media", kind, media if isinstance(media, str) else file_name, target.chat_id))
+        return None
+
+    async def send_album(media_list, kb, target):
+        await fail_or_record(("album", len(media_list), target.chat_id))
+        return [None] * len(media_list)
+
+    async def send_large(kind, spooled, file_name, kb, targets, sent=None, part=None):
+        for target in main.unsent(sent, part, targets):
+            await main.send_once(sent, part, target, lambda: fail_or_record(("large", kind, file_name, target.chat_id)))
+        return None
+
+    monkeypatch.setattr(main, "TELEGRAM_UPLOAD_LIMIT", LIMIT)
+    monkeypatch.setattr(main, "prepare_attachment", prepare_attachment)
+    monkeypatch.setattr(main, "send_media", send_media)
+    monkeypatch.setattr(main, "send_album", send_album)
+    monkeypatch.setattr(main, "send_large", send_large)
+    return calls, opened, failures
+
+
+def send(attaches, sent=None, targets=(main.Target("-1", None),)):
+    asyncio.run(main.send_attachments(None, attaches, 10, 1, targets=targets, sent=sent))
+
+
+def test_oversized_album_item_goes_separately_and_leftover_is_not_an_album(telegram):
+    calls, opened, _ = telegram
+    send([photo(), video(size=3 * LIMIT)])
+    assert calls == [("media", "photo", "media.jpg", "-1"), ("large", "video", "Видео", "-1")]
+    # для альбома большое видео не качали, скачали только для отдельной отправки
+    assert [max_size for a, max_size in opened if a["_type"] == "VIDEO"] == [None]
+
+
+def test_album_keeps_fitting_items_and_sends_oversized_after_it(telegram):
+    calls, _, _ = telegram
+    send([photo(), photo(), video(size=3 * LIMIT)])
+    assert calls == [("album", 2, "-1"), ("large", "video", "Видео", "-1")]
+
+
+def test_retry_after_album_still_sends_postponed_item(telegram):
+    calls, _, failures = telegram
+    failures[("large", "video")] = main.DeliveryFailed("сеть")
+    sent = []
+    attaches = [photo(), photo(), video(size=3 * LIMIT)]
+    with pytest.raises(main.DeliveryFailed):
+        send(attaches, sent=sent)
+    assert calls == [("album", 2, "-1")]
+    send(attaches, sent=sent)
+    assert calls == [("album", 2, "-1"), ("large", "video", "Видео", "-1")]
+
+
+def test_sent_parts_are_not_sent_again(telegram):
+    calls, _, failures = telegram
+    targets = (main.Target("-1", None), main.Target("-2", None))
+    failures[("media", "document")] = main.DeliveryFailed("сеть")
+    doc = {"_type": "FILE", "fileId": next(_ids), "baseUrl": "http://cdn/d", "name": "a.txt", "size": 10}
+    sent = []
+    attaches = [photo(), photo(), doc]
+    with pytest.raises(main.DeliveryFailed):
+        send(attaches, sent=sent, targets=targets)
+    send(attaches, sent=sent, targets=targets)
+    assert sorted(calls) == sorted([
+        ("album", 2, "-1"), ("album", 2, "-2"),
+        ("media", "document", "a.txt", "-1"), ("media", "document", "a.txt", "-2"),
+    ])
+
+
+def test_album_with_a_rejected_cached_file_id_is_uploaded_again(telegram):
+    calls, opened, failures = telegram
+    cached, fresh = photo(), photo()
+    main._cache.set("tg_file", f"photo:{main.MediaCache.key(cached)}", "OLD")
+    failures[("album", 2)] = RuntimeError("Bad Request: wrong file identifier")
+    send([cached, fresh])
+    assert calls == [("album", 2, "-1")]
+    # заново качали только элемент со старым file_id, а сам file_id забыт
+    assert [a for a, _ in opened] == [fresh, cached]
+    assert main._media_cache.get("photo", main.MediaCache.key(cached)) is None
+
+
+def test_retry_does_not_post_the_text_again(telegram, monkeypatch):
+    calls, _, failures = telegram
+    texts = []
+
+    async def send_to_telegram(text, sender_name=None, chat_name=None, escape=True, target=main.DEFAULT_TARGET):
+        texts.append((text, target.chat_id))
+
+    monkeypatch.setattr(main, "send_to_telegram", send_to_telegram)
+    failures[("media", "document")] = main.DeliveryFailed("сеть")
+    doc = {"_type": "FILE", "fileId": next(_ids), "baseUrl": "http://cdn/d", "name": "a.txt", "size": 10}
+    message = main.NormalizedMessage(128, 10, 1, "Аня", "Чат", "привет", [], None, [doc])
+    sent = []
+    targets = (main.Target("-1", None),)
+    with pytest.raises(main.DeliveryFailed):
+        asyncio.run(main.forward_message(None, message, targets, sent=sent))
+    asyncio.run(main.forward_message(None, message, targets, sent=sent))
+    assert texts == [("привет", "-1")]
+    assert calls == [("media", "document", "a.txt", "-1")]
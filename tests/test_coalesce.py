@@ -0,0 +1,8 @@
+import main
+
+
+def test_split_coalesced():
+    assert main.split_coalesced([], "H") == []
+    assert main.split_coalesced(["a", "b"], "H", limit=100) == ["H\n\na\n\nb"]
+    assert main.split_coalesced(["a" * 5, "b" * 5], "H", limit=10) == ["H\n\naaaaa", "H\n\nbbbbb"]
+    assert main.split_coalesced(["a", "b"], "", limit=3) == ["a", "b"]
@@ -0,0 +1,71 @@
+import asyncio
+import contextlib
+
+import aiohttp
+import aiohttp.web
+import pytest
+
+import main
+
+
+@contextlib.asynccontextmanager
+async def cdn(per_host, connect_timeout):
+    """Локальный CDN и сессия main с маленьким пулом соединений."""
+    async def serve(request):
+        # больше буферов сокета: пока тело не читают, соединение занято
+        return aiohttp.web.Response(body=b"x" * 4 * 1024 * 1024)
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/{name}", serve)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    site = aiohttp.web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit_per_host=per_host),
+        timeout=aiohttp.ClientTimeout(connect=connect_timeout),
+    )
+    previous, main._session = main._session, session
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        main._session = previous
+        await session.close()
+        await runner.cleanup()
+
+
+def test_prefetch_does_not_starve_the_connection_pool(monkeypatch):
+    delivered = []
+
+    async def send_media(kind, media, file_name, kb, target, caption=None):
+        async for _ in media.read(None):
+            pass
+        await asyncio.sleep(0.2)  # медленная выгрузка
+        delivered.append(file_name)
+
+    monkeypatch.setattr(main, "send_media", send_media)
+
+    async def run():
+        async with cdn(per_host=main.MESSAGE_DOWNLOAD_CONCURRENCY, connect_timeout=0.3) as base:
+            attaches = [{"_type": "FILE", "fileId": f"pool{i}", "baseUrl": f"{base}/f{i}", "name": f"f{i}"}
+                        for i in range(8)]
+            await main.send_attachments(None, attaches, 10, 1, targets=(main.Target("-1", None),))
+        # все места в очереди скачиваний вернулись
+        assert main._download_slots._value == main.GLOBAL_DOWNLOAD_CONCURRENCY
+
+    asyncio.run(run())
+    assert delivered == [f"f{i}" for i in range(8)]
+
+
+def test_waiting_for_a_pooled_connection_too_long_is_retried_later():
+    async def run():
+        async with cdn(per_host=1, connect_timeout=0.2) as base:
+            held = await main.open_attachment(f"{base}/a", "a")
+            try:
+                with pytest.raises(main.DeliveryFailed):
+                    await main.open_attachment(f"{base}/b", "b")
+            finally:
+                held.close()
+
+    asyncio.run(run())
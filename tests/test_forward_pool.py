@@ -0,0 +1,144 @@
+import asyncio
+import os
+import random
+import types
+
+import main
+
+CLIENT = types.SimpleNamespace(account=types.SimpleNamespace(name="a"))
+
+
+def message(n, chat_id=10):
+    return {"opcode": 128, "payload": {"chatId": chat_id, "message": {"id": n, "sender": 1, "text": f"m{n}"}}}
+
+
+def ids(handled):
+    return [data["payload"]["message"]["id"] for data in handled]
+
+
+async def drain(pool, handled, count, timeout=5):
+    pool.start()
+    pool.bind(CLIENT, {})
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(handled) < count and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+    await pool.stop()
+
+
+def recorder():
+    handled = []
+
+    async def handler(client, data, groups):
+        handled.append(data)
+
+    return handled, handler
+
+
+def test_each_chat_keeps_its_order_while_chats_run_in_parallel():
+    handled = []
+    running = set()
+    overlap = []
+
+    async def handler(client, data, groups):
+        chat_id = data["payload"]["chatId"]
+        assert chat_id not in running  # одну полосу ведёт один воркер
+        running.add(chat_id)
+        overlap.append(len(running))
+        await asyncio.sleep(random.uniform(0, 0.01))
+        running.discard(chat_id)
+        handled.append(data)
+
+    async def run():
+        pool = main.ForwardPool(handler, workers=4, maxsize=100, overflow="block")
+        for n in range(60):
+            await pool.put(message(n, chat_id=n % 3))
+        await drain(pool, handled, 60)
+
+    asyncio.run(run())
+    for chat_id in range(3):
+        chat = [data for data in handled if data["payload"]["chatId"] == chat_id]
+        assert ids(chat) == list(range(chat_id, 60, 3))
+    assert max(overlap) > 1
+
+
+def test_drop_oldest_drops_the_oldest_across_chats():
+    handled, handler = recorder()
+
+    async def run():
+        pool = main.ForwardPool(handler, workers=1, maxsize=3, overflow="drop_oldest")
+        for n in range(5):
+            await pool.put(message(n, chat_id=n % 2))
+        assert pool.dropped == 2
+        await drain(pool, handled, 3)
+
+    asyncio.run(run())
+    assert sorted(ids(handled)) == [2, 3, 4]
+
+
+def test_spill_keeps_order_and_removes_the_file(tmp_path):
+    handled, handler = recorder()
+    path = str(tmp_path / "spill.jsonl")
+
+    async def run():
+        pool = main.ForwardPool(handler, workers=2, maxsize=2, overflow="spill", spill_path=path)
+        for n in range(10):
+            await pool.put(message(n))
+        assert pool.spilled == 8
+        await drain(pool, handled, 10)
+
+    asyncio.run(run())
+    assert ids(handled) == list(range(10))
+    assert not os.path.exists(path)
+    assert not os.path.exists(f"{path}.offset")
+
+
+def test_spill_is_read_from_an_offset_and_survives_restart(tmp_path):
+    handled, handler = recorder()
+    path = str(tmp_path / "spill.jsonl")
+
+    async def run():
+        pool = main.ForwardPool(handler, workers=1, maxsize=2, overflow="spill", spill_path=path)
+        for n in range(6):
+            await pool.put(message(n))
+        # первые два "доставлены", освободилось место на два из файла
+        pool._lanes.clear()
+        pool.depth = 0
+        await pool._spill_file.flush()
+        size = os.path.getsize(path)
+        await pool._refill()
+        assert pool.spilled == 2
+        # файл не переписывается, только сдвигается offset
+        assert os.path.getsize(path) == size
+        await pool.stop()
+
+        restarted = main.ForwardPool(handler, workers=1, maxsize=2, overflow="spill", spill_path=path)
+        assert restarted.spilled == 2
+        await drain(restarted, handled, 2)
+
+    asyncio.run(run())
+    assert ids(handled) == [4, 5]
+
+
+def test_delivery_failed_is_retried_in_the_same_lane_then_marked_done(monkeypatch):
+    monkeypatch.setattr(main, "FORWARD_RETRY_DELAY", 0)
+    attempts = []
+    handled = []
+    done = []
+
+    async def handler(client, data, groups):
+        attempts.append(ids([data])[0])
+        if len(attempts) == 1:
+            raise main.DeliveryFailed("сеть")
+        handled.append(data)
+
+    async def run():
+        pool = main.ForwardPool(handler, workers=2, maxsize=10, overflow="block")
+        pool.journal = types.SimpleNamespace(done=done.append)
+        await pool.put(message(1))
+        await pool.put(message(2))
+        await drain(pool, handled, 2)
+
+    asyncio.run(run())
+    assert attempts == [1, 1, 2]
+    assert ids(handled) == [1, 2]
+    assert ids(done) == [1, 2]
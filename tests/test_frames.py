@@ -0,0 +1,8 @@
+import main
+
+
+def test_peek_header():
+    assert main.peek_header('{"ver":11,"cmd":0,"seq":5,"opcode":128,"payload":{"opcode":1}}') == (128, "5")
+    assert main.peek_header('{"opcode": "64", "payload": {}}') == (64, None)
+    assert main.peek_header('{"payload":{"opcode":1,"seq":2}}') is None
+    assert main.peek_header(b"{}") is None
@@ -0,0 +1,123 @@
+import asyncio
+import sqlite3
+
+import main
+
+
+class Pool:
+    """Вместо ForwardPool: просто запоминает, что ему отдали."""
+
+    def __init__(self):
+        self.journal = None
+        self.items = []
+        self.discarded = False
+
+    async def put(self, data):
+        self.items.append(data)
+
+    def discard_spill(self):
+        self.discarded = True
+
+
+def message(message_id, chat_id=10):
+    return {"opcode": 128, "payload": {"chatId": chat_id, "message": {"id": message_id, "sender": 1, "text": "t"}}}
+
+
+async def settle(pool, count, timeout=2):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while len(pool.items) < count and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.01)
+
+
+def test_write_error_is_retried_without_losing_the_batch(tmp_path, monkeypatch):
+    async def run():
+        pool = Pool()
+        journal = main.Journal(pool, path=str(tmp_path / "j.sqlite3"))
+        write = journal._write
+        calls = []
+
+        def flaky(batch, done):
+            calls.append(len(batch))
+            if len(calls) == 1:
+                raise sqlite3.OperationalError("disk I/O error")
+            return write(batch, done)
+
+        monkeypatch.setattr(journal, "_write", flaky)
+        journal.start()
+        await journal.append(message(1))
+        await journal.append(message(2))
+        await settle(pool, 2)
+        assert not journal._task.done()
+        await journal.stop()
+        return pool.items
+
+    items = asyncio.run(run())
+    assert [data["payload"]["message"]["id"] for data in items] == [1, 2]
+
+
+def test_journal_that_keeps_failing_falls_back_to_the_pool(tmp_path, monkeypatch):
+    async def run():
+        pool = Pool()
+        journal = main.Journal(pool, path=str(tmp_path / "j.sqlite3"))
+
+        def broken(batch, done):
+            raise sqlite3.OperationalError("database or disk is full")
+
+        monkeypatch.setattr(journal, "_write", broken)
+        journal.start()
+        for i in range(main.JOURNAL_BATCH_SIZE * 5):
+            await asyncio.wait_for(journal.append(message(i)), 5)
+        await settle(pool, main.JOURNAL_BATCH_SIZE * 5, timeout=10)
+        await journal.stop()
+        return pool.items
+
+    items = asyncio.run(run())
+    assert [data["payload"]["message"]["id"] for data in items] == list(range(main.JOURNAL_BATCH_SIZE * 5))
+
+
+def test_undelivered_messages_are_replayed_after_restart(tmp_path):
+    path = str(tmp_path / "j.sqlite3")
+
+    async def first_run():
+        pool = Pool()
+        journal = main.Journal(pool, path=path)
+        journal.start()
+        for i in (1, 2, 3):
+            await journal.append(message(i))
+        await settle(pool, 3)
+        journal.done(pool.items[0])
+        journal.done(pool.items[2])
+        await journal.stop()
+
+    async def second_run():
+        pool = Pool()
+        journal = main.Journal(pool, path=path)
+        journal.start()
+        await settle(pool, 1)
+        await journal.stop()
+        return pool
+
+    asyncio.run(first_run())
+    pool = asyncio.run(second_run())
+    assert pool.discarded  # файл переполнения не нужен, всё есть в журнале
+    assert [data["payload"]["message"]["id"] for data in pool.items] == [2]
+
+
+def test_repeated_message_ids_are_forwarded_once(tmp_path):
+    async def run():
+        pool = Pool()
+        journal = main.Journal(pool, path=str(tmp_path / "j.sqlite3"))
+        journal.start()
+        await journal.append(message(1))
+        await journal.append(message(1))
+        await settle(pool, 1)
+        # повтор уже закоммиченного (например, Max прислал его снова после реконнекта)
+        await journal.append(message(1))
+        await journal.append(message(1, chat_id=11))
+        await settle(pool, 2)
+        await asyncio.sleep(0.1)
+        await journal.stop()
+        return pool.items
+
+    items = asyncio.run(run())
+    assert [(data["payload"]["chatId"], data["payload"]["message"]["id"]) for data in items] == [(10, 1), (11, 1)]
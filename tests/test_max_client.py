@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+from websockets.exceptions import ConnectionClosedError
+
+import main
+
+
+class Socket:
+    def __init__(self, error=None):
+        self.error = error
+        self.sent = []
+
+    async def send(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.sent.append(frame)
+
+
+def test_close_fails_pending_requests_at_once():
+    async def run():
+        client = main.MaxClient(Socket(), account=None)
+        call = asyncio.create_task(client.request(88, {}, timeout=30))
+        await asyncio.sleep(0)
+        assert client.in_flight == 1
+        client.close()
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(call, 1)
+        assert client.in_flight == 0
+        with pytest.raises(ConnectionError):
+            await client.request(88, {})
+
+    asyncio.run(run())
+
+
+def test_reply_is_dispatched_by_seq():
+    async def run():
+        client = main.MaxClient(Socket(), account=None)
+        call = asyncio.create_task(client.request(88, {}, timeout=1))
+        await asyncio.sleep(0)
+        seq = main.json_loads(client.websocket.sent[0])["seq"]
+        assert client.expects(str(seq))
+        assert client.dispatch({"seq": seq, "payload": {"url": "u"}})
+        assert (await call)["payload"] == {"url": "u"}
+        assert not client.dispatch({"seq": seq})
+
+    asyncio.run(run())
+
+
+def test_send_on_dead_socket_is_a_connection_error():
+    async def run():
+        client = main.MaxClient(Socket(ConnectionClosedError(None, None)), account=None)
+        with pytest.raises(ConnectionError):
+            await client.request(88, {})
+        assert client.in_flight == 0
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize("resolve", [main.get_file_url, main.get_video_url])
+def test_url_lookup_on_dead_socket_is_retried_later(resolve):
+    async def run():
+        client = main.MaxClient(Socket(ConnectionClosedError(None, None)), account=None)
+        with pytest.raises(main.DeliveryFailed):
+            await resolve(client, "f1", 10, 1)
+
+    asyncio.run(run())
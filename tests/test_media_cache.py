@@ -0,0 +1,34 @@
+import asyncio
+import os
+
+import main
+
+
+class Download:
+    def __init__(self, body, name="f"):
+        self.body = body
+        self.filename = name
+        self.url = f"http://cdn/{name}"
+
+    async def read(self, bot):
+        for i in range(0, len(self.body), 4):
+            yield self.body[i:i + 4]
+
+
+def test_spool_dedupes_by_content_and_evicts_oldest(tmp_path):
+    cache = main.MediaCache(blob_dir=str(tmp_path), blob_max_bytes=25)
+
+    async def run():
+        first = await cache.spool(Download(b"a" * 10), "k1")
+        os.utime(first.path, (1, 1))  # самый старый
+        same = await cache.spool(Download(b"a" * 10), "k2")
+        assert same.path == first.path
+        second = await cache.spool(Download(b"b" * 10), "k3")
+        third = await cache.spool(Download(b"c" * 10), "k4")
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert not os.path.exists(first.path)
+    assert os.path.exists(second.path) and os.path.exists(third.path)
+    assert cache.stats()["blob_bytes"] == 20
+    assert sorted(os.listdir(tmp_path)) == sorted([second.digest, third.digest])
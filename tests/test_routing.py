@@ -0,0 +1,116 @@
+import json
+import os
+import types
+
+import pytest
+
+import main
+
+Target = main.Target
+MAIN_TARGET = Target("-100", None)
+
+
+def account(name="a", allowed=()):
+    return types.SimpleNamespace(name=name, target=MAIN_TARGET, allowed_chat_ids=set(allowed))
+
+
+def group(chat_id, sender=1, text="", attaches=(), forward=None):
+    message = {"id": 1, "sender": sender, "text": text, "attaches": list(attaches)}
+    if forward is not None:
+        message["link"] = {"type": "FORWARD", "message": forward}
+    return {"opcode": 128, "payload": {"chatId": chat_id, "message": message}}
+
+
+def private(sender, text=""):
+    return {"opcode": 64, "payload": {"message": {"id": 1, "sender": sender, "text": text}}}
+
+
+def router(config):
+    r = main.Router(path="")
+    r._table = main.Router.compile(config)
+    return r
+
+
+def test_no_rules_goes_to_account_target():
+    assert router([]).route(account(), group(10)) == [MAIN_TARGET]
+
+
+def test_allowed_chats_filter_groups_but_not_private():
+    r = router([{"to": "-1"}])
+    acc = account(allowed={"10"})
+    assert r.route(acc, group(11)) == []
+    assert r.route(acc, group(10)) == [Target("-1", None)]
+    assert r.route(acc, private(11)) == [Target("-1", None)]
+
+
+def test_indexed_rules_are_checked_in_file_order():
+    # правила из индекса по чату, по отправителю и без условий перемешаны в файле
+    r = router([
+        {"to": "-3"},
+        {"senders": 7, "to": "-2"},
+        {"chats": [10], "to": "-1"},
+        {"to": {"chat_id": "-4", "thread_id": 5}},
+    ])
+    assert r.route(account(), group(10, sender=7)) == [
+        Target("-3", None), Target("-2", None), Target("-1", None), Target("-4", 5),
+    ]
+    assert r.route(account(), group(11, sender=8)) == [Target("-3", None), Target("-4", 5)]
+
+
+def test_stop_ends_matching_and_keeps_earlier_targets():
+    r = router([
+        {"to": "-1"},
+        {"chats": 10, "to": "-2", "stop": True},
+        {"to": "-3"},
+    ])
+    assert r.route(account(), group(10)) == [Target("-1", None), Target("-2", None)]
+    assert r.route(account(), group(11)) == [Target("-1", None), Target("-3", None)]
+
+
+def test_drop_discards_message():
+    r = router([{"senders": [7], "drop": True}, {"to": "-1"}])
+    assert r.route(account(), group(10, sender=7)) == []
+    assert r.route(account(), group(10, sender=8)) == [Target("-1", None)]
+
+
+def test_default_target_and_fallback():
+    r = router([{"chats": 10, "to": ["default", "-1", "-1"]}])
+    assert r.route(account(), group(10)) == [MAIN_TARGET, Target("-1", None)]
+    assert r.route(account(), group(11)) == [MAIN_TARGET]
+    r = router({"default": False, "rules": [{"chats": 10, "to": "-1"}]})
+    assert r.route(account(), group(11)) == []
+
+
+def test_account_and_private_filters():
+    r = router([
+        {"account": "b", "to": "-1"},
+        {"private": True, "to": "-2"},
+        {"private": False, "to": "-3"},
+    ])
+    assert r.route(account("a"), private(7)) == [Target("-2", None)]
+    assert r.route(account("b"), group(10)) == [Target("-1", None), Target("-3", None)]
+
+
+def test_types_and_text_look_into_forwards():
+    r = router([
+        {"types": ["photo"], "to": "-1"},
+        {"types": "forward", "text": "(?i)срочно", "to": "-2"},
+    ])
+    photo = group(10, forward={"sender": 2, "text": "СРОЧНО", "attaches": [{"_type": "PHOTO"}]})
+    assert r.route(account(), photo) == [Target("-1", None), Target("-2", None)]
+    assert r.route(account(), group(10, text="срочно")) == [MAIN_TARGET]
+
+
+def test_rule_without_target_is_rejected():
+    with pytest.raises(ValueError):
+        main.Router.compile([{"chats": 10}])
+
+
+def test_broken_file_keeps_previous_rules(tmp_path):
+    path = tmp_path / "routes.json"
+    path.write_text(json.dumps([{"to": "-1"}]), encoding="utf-8")
+    r = main.Router(path=str(path))
+    path.write_text("[", encoding="utf-8")
+    os.utime(path, (r.mtime + 10, r.mtime + 10))
+    r.maybe_reload()
+    assert r.route(account(), group(10)) == [Target("-1", None)]
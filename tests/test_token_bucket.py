@@ -0,0 +1,18 @@
+import asyncio
+
+import main
+
+
+def test_token_bucket_waits_for_tokens_and_pause():
+    async def run():
+        bucket = main.TokenBucket(rate=100, capacity=2)
+        assert await bucket.acquire() == 0
+        assert await bucket.acquire() == 0
+        assert await bucket.acquire() > 0
+        bucket.pause(0.05)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await bucket.acquire()
+        assert loop.time() - started >= 0.04
+
+    asyncio.run(run())